@@ -1,8 +1,13 @@
 #!/usr/bin/python3
 
+import os
+import pwd
 import sqlite3
 import sys
 import time
+import bisect
+import calendar
+import ipaddress
 import datetime
 import logging
 import argparse
@@ -31,10 +36,383 @@ class TemplateError(Exception):
     """Generated when the Jinja template contains an error"""
     pass
 
-class ReportBuilder(object):
-    """Build a report for a specific user"""
+# Settings of the script, e.g. the providers resolution
+SETTINGS_PATH = "/etc/homebox/access-report.d/access-report.conf"
+
+# Providers cache, shared by all the users
+PROVIDERS_CACHE_PATH = "/var/cache/homebox/access-report/providers.db"
+
+# Optional store of the connections of all the users
+STORE_PATH = "/var/lib/homebox/access-report/connections.db"
+
+# Schema migrations of the connections databases, applied in order.
+# The number of migrations applied is stored in the user_version pragma.
+MIGRATIONS = [
+    # Daily aggregates of the connections, and the last connection processed
+    [
+        "create table if not exists connections_rollup ("
+        " day DATE, hour INTEGER, countryName VARCHAR, provider VARCHAR,"
+        " source VARCHAR, status CHAR(10), ip VARCHAR, count INTEGER,"
+        " firstSeen TIMESTAMP, lastSeen TIMESTAMP)",
+        "create table if not exists rollup_state (lastRowid INTEGER)",
+    ],
+    # Covering indexes, to read the connections and the aggregates from the indexes only
+    [
+        "drop index if exists rollup_day_idx",
+        "drop index if exists rollup_key_idx",
+        "create index if not exists rollup_covering_idx on connections_rollup"
+        " (day, hour, ip, source, status, provider, countryName, count, firstSeen, lastSeen)",
+        "create index if not exists period_covering_idx on connections"
+        " (unixtime, countryName, provider, source, status, ip)",
+        "create index if not exists provider_covering_idx on connections (provider, ip, unixtime)",
+    ],
+    # Normalised layout: dictionary tables, integer foreign keys and epoch times.
+    # The connections keep their rowid, so the last connection aggregated is still valid,
+    # and the new ids always increase, even once the last connections have been pruned.
+    [
+        "create table if not exists countries (id INTEGER PRIMARY KEY, code CHAR(2), name VARCHAR, UNIQUE (code, name))",
+        "create table if not exists providers (id INTEGER PRIMARY KEY, name VARCHAR UNIQUE)",
+        "create table if not exists sources (id INTEGER PRIMARY KEY, name VARCHAR UNIQUE)",
+        "create table if not exists statuses (id INTEGER PRIMARY KEY, name VARCHAR UNIQUE)",
+        "insert or ignore into countries (code, name)"
+        " select distinct countryCode, countryName from connections where countryCode is not null",
+        "insert or ignore into providers (name) select distinct provider from connections where provider is not null",
+        "insert or ignore into sources (name) select distinct source from connections where source is not null",
+        "insert or ignore into statuses (name) select distinct status from connections where status is not null",
+        "create table connections_log ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT, time INTEGER, ip VARCHAR,"
+        " country INTEGER REFERENCES countries, provider INTEGER REFERENCES providers,"
+        " source INTEGER REFERENCES sources, status INTEGER REFERENCES statuses,"
+        " mobile BOOLEAN DEFAULT NULL, type CHAR(10) DEFAULT NULL,"
+        " score SMALLINT DEFAULT 0, details TEXT DEFAULT '')",
+        "insert into connections_log"
+        " select c.rowid, cast(strftime('%s', c.unixtime) as integer), c.ip,"
+        " countries.id, providers.id, sources.id, statuses.id, c.mobile, c.type, c.score, c.details"
+        " from connections c"
+        " left join countries on countries.code = c.countryCode and countries.name is c.countryName"
+        " left join providers on providers.name = c.provider"
+        " left join sources on sources.name = c.source"
+        " left join statuses on statuses.name = c.status",
+        "insert into sqlite_sequence (name, seq) select 'connections_log', 0"
+        " where not exists (select 1 from sqlite_sequence where name = 'connections_log')",
+        "update sqlite_sequence set seq = max(seq, (select coalesce(max(lastRowid), 0) from rollup_state))"
+        " where name = 'connections_log'",
+        "drop table connections",
+        "create index log_period_idx on connections_log (time, country, provider, source, status, ip)",
+        "create index log_provider_idx on connections_log (provider, ip, time)",
+        # The previous layout, to inspect the connections by hand
+        "create view connections as"
+        " select l.id, datetime(l.time, 'unixepoch') as unixtime, l.ip, countries.code as countryCode,"
+        " countries.name as countryName, sources.name as source, providers.name as provider,"
+        " l.mobile, l.type, statuses.name as status, l.score, l.details"
+        " from connections_log l"
+        " left join countries on countries.id = l.country"
+        " left join providers on providers.id = l.provider"
+        " left join sources on sources.id = l.source"
+        " left join statuses on statuses.id = l.status",
+        # The connections can still be logged with the previous layout
+        "create trigger connections_insert instead of insert on connections"
+        " begin"
+        " insert or ignore into countries (code, name) select new.countryCode, new.countryName"
+        "  where new.countryCode is not null;"
+        " insert or ignore into providers (name) select new.provider where new.provider is not null;"
+        " insert or ignore into sources (name) select new.source where new.source is not null;"
+        " insert or ignore into statuses (name) select new.status where new.status is not null;"
+        " insert into connections_log (time, ip, country, provider, source, status, mobile, type, score, details)"
+        "  values (cast(strftime('%s', coalesce(new.unixtime, 'now')) as integer), new.ip,"
+        "  (select id from countries where code = new.countryCode and name is new.countryName),"
+        "  (select id from providers where name = new.provider),"
+        "  (select id from sources where name = new.source),"
+        "  (select id from statuses where name = new.status),"
+        "  new.mobile, new.type, coalesce(new.score, 0), coalesce(new.details, ''));"
+        " end",
+    ],
+]
+
+# Migration introducing the normalised layout of the connections
+NORMALISED_VERSION = 3
+
+# Daily aggregates of the connections, in the normalised layout
+AGGREGATE_COLUMNS = (
+    "date(l.time, 'unixepoch'), cast(strftime('%H', l.time, 'unixepoch') as integer),"
+    " countries.name, providers.name, sources.name, statuses.name, l.ip, count(*),"
+    " datetime(min(l.time), 'unixepoch'), datetime(max(l.time), 'unixepoch')"
+    " from connections_log l"
+    " left join countries on countries.id = l.country"
+    " left join providers on providers.id = l.provider"
+    " left join sources on sources.id = l.source"
+    " left join statuses on statuses.id = l.status")
+
+AGGREGATE_GROUPS = (
+    " group by date(l.time, 'unixepoch'), strftime('%H', l.time, 'unixepoch'),"
+    " l.country, l.provider, l.source, l.status, l.ip")
+
+def readSettings(settingsPath=None):
+    """Read the settings of the script"""
+    import configparser
+
+    settings = configparser.RawConfigParser()
+    settings.read(settingsPath or SETTINGS_PATH)
+    return settings
+
+
+class ProviderCache(object):
+    """Persistent cache of the providers, by network prefix, shared by all the users.
+    Opened read-only when not writable, e.g. when the report is built by a user."""
+
+    def __init__(self, path, maxAge):
+        self.path = path
+        self.maxAge = maxAge
+        self.conn = None
+        self.writable = False
+
+        try:
+            if os.access(path, os.W_OK) or (not os.path.exists(path) and os.access(os.path.dirname(path), os.W_OK)):
+                self.conn = sqlite3.connect(path)
+                self.conn.execute("create table if not exists providers ("
+                                  " prefix VARCHAR PRIMARY KEY, provider VARCHAR, updated INTEGER)"
+                                  " WITHOUT ROWID")
+                self.writable = True
+            elif os.path.exists(path):
+                self.conn = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+        except Exception as error:
+            logging.warning("Could not open the providers cache '{}': {}".format(path, error))
+            self.conn = None
+
+    @staticmethod
+    def prefix(ip):
+        """Return the network prefix of an IP address: /24 for IPv4, /48 for IPv6"""
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return ip
+        length = 24 if address.version == 4 else 48
+        return str(ipaddress.ip_network("{}/{}".format(ip, length), strict=False))
+
+    def get(self, ips):
+        """Return the cached providers of the IP addresses, by IP address"""
+        providers = {}
+        if self.conn is None:
+            return providers
+
+        prefixes = {}
+        for ip in ips:
+            prefixes.setdefault(self.prefix(ip), []).append(ip)
+
+        minUpdate = int(time.time()) - self.maxAge * 86400
+        query = "select provider from providers where prefix=? and updated >= ?"
+        for prefix, prefixIps in prefixes.items():
+            row = self.conn.execute(query, (prefix, minUpdate)).fetchone()
+            if row:
+                for ip in prefixIps:
+                    providers[ip] = row[0]
+
+        return providers
+
+    def update(self, providers):
+        """Store the providers resolved, by IP address"""
+        if not self.writable or not providers:
+            return
+
+        now = int(time.time())
+        try:
+            with self.conn:
+                self.conn.executemany("insert or replace into providers values (?, ?, ?)",
+                                      [(self.prefix(ip), provider, now) for ip, provider in providers.items()])
+        except Exception as error:
+            logging.warning("Could not update the providers cache '{}': {}".format(self.path, error))
+
+
+class HttpResolver(object):
+    """Resolve the providers with the batch endpoint of ip-api.com, or a compatible server"""
+
+    def __init__(self, url, batchSize):
+        self.url = url
+        self.batchSize = batchSize
+
+    def resolve(self, ips):
+        """Return the providers found, by IP address. Empty when the provider is not known"""
+        import requests
+
+        providers = {}
+        for start in range(0, len(ips), self.batchSize):
+            batch = ips[start:start + self.batchSize]
+            try:
+                response = requests.post(self.url, params={'fields': 'status,isp,query'},
+                                         json=batch, timeout=10)
+                response.raise_for_status()
+                for result in response.json():
+                    isp = result.get('isp', '') if result.get('status') == 'success' else ''
+                    providers[result['query']] = isp
+            except Exception as error:
+                logging.warning("Could not resolve the providers with {}: {}".format(self.url, error))
+                break
+
+            # Wait for the next window when the rate limit is reached, to avoid being blacklisted
+            if response.headers.get('X-Rl') == '0' and start + self.batchSize < len(ips):
+                time.sleep(int(response.headers.get('X-Ttl', 60)) + 1)
+
+        return providers
+
+
+class AsnResolver(object):
+    """Resolve the providers offline, from an ASN database file in the iptoasn.com format:
+    range start, range end, AS number, country code and AS description, separated by tabs"""
+
+    def __init__(self, path):
+        self.path = path
+        self.ranges = None
+
+    def load(self):
+        """Load the address ranges, sorted by start, once per version"""
+        ranges = {4: [], 6: []}
+        with open(self.path) as asnFile:
+            for line in asnFile:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) < 5 or fields[2] == '0':
+                    continue
+                start = ipaddress.ip_address(fields[0])
+                end = ipaddress.ip_address(fields[1])
+                ranges[start.version].append((int(start), int(end), fields[4]))
+
+        self.ranges = {}
+        for version, versionRanges in ranges.items():
+            versionRanges.sort()
+            self.ranges[version] = ([r[0] for r in versionRanges], versionRanges)
+
+    def resolve(self, ips):
+        """Return the providers found, by IP address. Empty when the provider is not known"""
+        if self.ranges is None:
+            try:
+                self.load()
+            except Exception as error:
+                logging.warning("Could not read the ASN database '{}': {}".format(self.path, error))
+                return {}
+
+        providers = {}
+        for ip in ips:
+            try:
+                address = ipaddress.ip_address(ip)
+            except ValueError:
+                providers[ip] = ''
+                continue
+            starts, ranges = self.ranges[address.version]
+            index = bisect.bisect_right(starts, int(address)) - 1
+            if index >= 0 and ranges[index][1] >= int(address):
+                providers[ip] = ranges[index][2]
+            else:
+                providers[ip] = ''
+
+        return providers
 
-    def __init__(self, user, period):
+
+class ProviderResolver(object):
+    """Resolve the providers of IP addresses, from the shared cache first,
+    then in batches with the configured backend"""
+
+    def __init__(self, settingsPath=None):
+        settings = readSettings(settingsPath)
+        backend = settings.get('providers', 'resolver', fallback='http')
+        self.cache = ProviderCache(settings.get('providers', 'cache', fallback=PROVIDERS_CACHE_PATH),
+                                   settings.getint('providers', 'max_age', fallback=90))
+
+        if backend == 'asn':
+            self.backend = AsnResolver(settings.get('providers', 'asn_database'))
+        elif backend == 'http':
+            self.backend = HttpResolver(settings.get('providers', 'url', fallback='http://ip-api.com/batch'),
+                                        settings.getint('providers', 'batch_size', fallback=100))
+        else:
+            self.backend = None
+
+    def resolve(self, ips):
+        """Return the providers of the IP addresses, by IP address.
+        The addresses that could not be resolved are missing, to try again later."""
+        providers = {}
+        unknown = []
+        for ip in ips:
+            try:
+                if ipaddress.ip_address(ip).is_private:
+                    providers[ip] = 'unknown'
+                    continue
+            except ValueError:
+                providers[ip] = 'unknown'
+                continue
+            unknown.append(ip)
+
+        providers.update(self.cache.get(unknown))
+        unknown = [ip for ip in unknown if ip not in providers]
+
+        if unknown and self.backend is not None:
+            # Resolve one address per network prefix
+            prefixes = {}
+            for ip in unknown:
+                prefixes.setdefault(ProviderCache.prefix(ip), []).append(ip)
+            resolved = self.backend.resolve([prefixIps[0] for prefixIps in prefixes.values()])
+            resolved = dict((ip, provider or 'unknown') for ip, provider in resolved.items())
+            self.cache.update(resolved)
+
+            for prefixIps in prefixes.values():
+                if prefixIps[0] in resolved:
+                    for ip in prefixIps:
+                        providers[ip] = resolved[prefixIps[0]]
+
+        logging.info("Resolved {} provider(s), {} not in the cache".format(len(providers), len(unknown)))
+        return providers
+
+
+class ReportBuilder(object):
+    """Build a report for a specific user.
+    The reports are read from daily aggregates of the connections, stored in the
+    connections_rollup table, and updated before each report for the new rows only."""
+
+    # Queries on the connections and the aggregates. The selections are checked
+    # by the tests to use the indexes only
+    QUERIES = {
+        'nbConnections':
+            "select count(*) from connections_log where time >= ? and time < ?",
+        'unresolvedAddresses':
+            "select distinct ip from connections_log where provider is null",
+        'unresolvedDays':
+            "select distinct date(time, 'unixepoch') from connections_log where provider is null",
+        'setProvider':
+            "update connections_log set provider = (select id from providers where name = ?)"
+            " where ip = ? and provider is null",
+        'aggregateDay':
+            "select " + AGGREGATE_COLUMNS + " where l.time >= ? and l.time < ?" + AGGREGATE_GROUPS,
+        'insertDay':
+            "insert into connections_rollup"
+            " select " + AGGREGATE_COLUMNS + " where l.time >= ? and l.time < ?" + AGGREGATE_GROUPS,
+        'deleteDay':
+            "delete from connections_rollup where day = ?",
+        'newConnections':
+            "select " + AGGREGATE_COLUMNS + " where l.id > ?" + AGGREGATE_GROUPS,
+        # The null values are compared with "is", the rows cannot be merged with a unique key
+        'updateGroup':
+            "update connections_rollup set count = count + ?, firstSeen = min(firstSeen, ?), lastSeen = max(lastSeen, ?)"
+            " where day = ? and hour = ? and ip is ? and source is ? and status is ?"
+            " and provider is ? and countryName is ?",
+        'insertGroup':
+            "insert into connections_rollup values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        'lastRowid':
+            "select lastRowid from rollup_state",
+        'maxRowid':
+            "select coalesce(max(id), 0) from connections_log",
+        'setLastRowid':
+            "insert into rollup_state values (?)",
+        'clearState':
+            "delete from rollup_state",
+        'clearRollup':
+            "delete from connections_rollup",
+        'firstDay':
+            "select date(min(time), 'unixepoch') from connections_log",
+        'pruneRollup':
+            "delete from connections_rollup where day < ?",
+        'reports':
+            "select hour, countryName, provider, source, status, ip, count, firstSeen, lastSeen"
+            " from connections_rollup where day >= ? and day < ?",
+    }
+
+    def __init__(self, user, period, readOnly=False):
         self.mail = "{}".format(user)
         self.home = "/home/users/" + user
         self.secdir = self.home + "/security"
@@ -42,9 +420,15 @@ class ReportBuilder(object):
         self.sendReport = False
         self.period = period
 
+        # Parameters prepended to the parameters of each query
+        self.scope = ()
+
         # Open the connection
         try:
-            self.conn = sqlite3.connect(self.connLogFile)
+            if readOnly:
+                self.conn = sqlite3.connect("file:{}?mode=ro".format(self.connLogFile), uri=True)
+            else:
+                self.conn = sqlite3.connect(self.connLogFile)
             if not self.conn:
                 raise DatabaseAccessError("Could not open the database '{}'"
                                           .format(self.connLogFile))
@@ -54,220 +438,507 @@ class ReportBuilder(object):
 
         logging.info("Opened database successfully")
 
-        # Initialise the period, one month by default
+        if not readOnly:
+            self.migrate()
+        self.version = self.conn.execute("pragma user_version").fetchone()[0]
+
+        self.initPeriod(period)
+
+    def initPeriod(self, period):
+        """Initialise the period, from the first day included to the last day excluded"""
         day = datetime.date.today()
+        tomorrow = day + datetime.timedelta(days=1)
         if period == Period.lastWeek:
             lastWeek = day - datetime.timedelta(days=7)
-            self.periodFilter = lastWeek.strftime("%Y-%m-%d")
-            self.dateColumns = "strftime('%d (%H:%M)',min(unixtime)),strftime('%d (%H:%M)',max(unixtime))"
+            self.periodStart = lastWeek.strftime("%Y-%m-%d")
+            self.periodEnd = tomorrow.strftime("%Y-%m-%d")
+            self.dateFormat = "%d (%H:%M)"
         elif period == Period.lastMonth:
             day = day.replace(day=1)
             lastMonth = day - datetime.timedelta(days=1)
-            self.periodFilter = lastMonth.strftime("%Y-%m-01")
-            self.dateColumns = "strftime('%d (%H:%M)',min(unixtime)),strftime('%d (%H:%M)',max(unixtime))"
+            self.periodStart = lastMonth.strftime("%Y-%m-01")
+            self.periodEnd = day.strftime("%Y-%m-%d")
+            self.dateFormat = "%d (%H:%M)"
         elif period == Period.lastYear:
             day = day.replace(day=1)
             day = day.replace(month=1)
             lastYear = day - datetime.timedelta(days=1)
-            self.periodFilter = lastYear.strftime("%Y-01-01")
-            self.dateColumns = "strftime('%d/%m', min(unixtime)),strftime('%d/%m', max(unixtime))"
+            self.periodStart = lastYear.strftime("%Y-01-01")
+            self.periodEnd = day.strftime("%Y-%m-%d")
+            self.dateFormat = "%d/%m"
         else:
-            self.periodFilter = ""
-            self.dateColumns = "strftime('%d/%m/%Y',min(unixtime)),strftime('%d/%m/%Y',max(unixtime))"
+            self.periodStart = ""
+            self.periodEnd = tomorrow.strftime("%Y-%m-%d")
+            self.dateFormat = "%d/%m/%Y"
+
+        # The connections times are stored in seconds since the epoch, in UTC
+        self.periodStartTime = self.epoch(self.periodStart)
+        self.periodEndTime = self.epoch(self.periodEnd)
 
-        logging.info("Looking for connections > {}".format(self.periodFilter))
+        logging.info("Looking for connections from {} to {}".format(self.periodStart, self.periodEnd))
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.conn.close()
 
+    @staticmethod
+    def epoch(day):
+        """Return the time of a day, in seconds since the epoch"""
+        if not day:
+            return 0
+        return calendar.timegm(datetime.datetime.strptime(day, "%Y-%m-%d").timetuple())
+
+    def execute(self, name, *params):
+        """Execute one of the queries, in the scope of the builder"""
+        return self.conn.execute(self.QUERIES[name], self.scope + params)
+
+    def migrate(self):
+        """Apply the schema migrations not applied yet, each one in its own transaction"""
+        version = self.conn.execute("pragma user_version").fetchone()[0]
+
+        for number in range(version, len(MIGRATIONS)):
+            try:
+                self.conn.execute("begin")
+                for statement in MIGRATIONS[number]:
+                    self.conn.execute(statement)
+                self.conn.execute("pragma user_version = {}".format(number + 1))
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise DatabaseAccessError("Could not migrate the database '{}' to version {}"
+                                          .format(self.connLogFile, number + 1))
+
+            logging.info("Migrated the database to version {}".format(number + 1))
+
+        # Reclaim the space of the previous layout
+        if version < NORMALISED_VERSION <= len(MIGRATIONS):
+            self.conn.execute("vacuum")
+
     def nbConnections(self):
         """Return the number of connections for this period"""
-        condition = "unixtime > '{}%'".format(self.periodFilter)
-        cursor = self.conn.execute("select count(*) from connections where {}"
-                                   .format(condition))
+        cursor = self.execute('nbConnections', self.periodStartTime, self.periodEndTime)
         count = cursor.fetchone()[0]
         return count
 
-    def updateProviders(self):
-        """Update providers from IP addresses, when enpty"""
-        import requests
-        query = "select distinct(ip) from connections where provider is null;"
-        cursor = self.conn.execute(query)
-        updates = []
-
-        for row in cursor:
-            ip = row[0]
-            provider = requests.get('http://ip-api.com/line/{}?fields=isp'
-                                    .format(ip)).text.replace("\n", "")
-            update = {}
-            update['query'] = "update connections set provider=? where ip=?"
-            if provider != "":
-                update['columns'] = (provider, ip)
-            else:
-                update['columns'] = ('unknown', ip)
-            updates.append(update)
-            # Sleep one second to avoid being blacklisted by the server
-            time.sleep(1)
+    def unresolvedAddresses(self):
+        """Return the IP addresses without provider"""
+
+        # Opened read-only, the database may not be migrated yet
+        if self.version < NORMALISED_VERSION:
+            query = "select distinct ip from connections where provider is null"
+            return [row[0] for row in self.conn.execute(query)]
+
+        return [row[0] for row in self.execute('unresolvedAddresses')]
+
+    def updateProviders(self, resolver=None):
+        """Update providers from IP addresses, when empty"""
+        ips = self.unresolvedAddresses()
+        if not ips:
+            return
+
+        # The days of the updated addresses are aggregated again
+        cursor = self.execute('unresolvedDays')
+        days = [row[0] for row in cursor if row[0]]
+
+        providers = (resolver or ProviderResolver()).resolve(ips)
 
         try:
-            writeCursor = self.conn.cursor()
-            for update in updates:
-                writeCursor.execute(update['query'], update['columns'])
+            self.conn.executemany("insert or ignore into providers (name) values (?)",
+                                  [(provider, ) for provider in set(providers.values())])
+            self.conn.executemany(self.QUERIES['setProvider'],
+                                  [self.scope + (provider, ip) for ip, provider in providers.items()])
             self.conn.commit()
         except Exception:
             raise DatabaseAccessError("Could not open the database '{}' for writing"
                                       .format(self.connLogFile))
 
-    def reportByProvider(self):
-        """Get the statistics by ISP (Internet Service Provider)"""
-        condition = "unixtime > '{}%' and provider != 'private'".format(self.periodFilter)
-        timeColumns = "count(ip) as count," + self.dateColumns
-        group = "group by provider"
-        order = "order by count desc"
-        query = "select provider,countryName,{} from connections where {} {} {}".format(
-            timeColumns, condition, group, order)
-        cursor = self.conn.execute(query)
+        if providers:
+            self.updateRollup(days)
+
+    def aggregateDays(self, days):
+        """Aggregate again all the connections of the days specified"""
+        for day in sorted(days):
+            nextDay = (datetime.datetime.strptime(day, "%Y-%m-%d") + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+            self.execute('deleteDay', day)
+            self.execute('insertDay', self.epoch(day), self.epoch(nextDay))
+
+    def foldNewConnections(self, lastRowid, skipDays):
+        """Add the connections after the last rowid processed to the running aggregates,
+        except for the days already aggregated again. Return the number of groups updated"""
+        cursor = self.execute('newConnections', lastRowid)
+
+        groups = 0
+        for day, hour, country, provider, source, status, ip, count, firstSeen, lastSeen in cursor.fetchall():
+            if day is None or day in skipDays:
+                continue
+            groups += 1
+            updated = self.execute('updateGroup', count, firstSeen, lastSeen, day, hour, ip,
+                                   source, status, provider, country)
+            if updated.rowcount == 0:
+                self.execute('insertGroup', day, hour, country, provider, source, status, ip,
+                             count, firstSeen, lastSeen)
+
+        return groups
+
+    def updateRollup(self, days=None):
+        """Fold the connections added since the last update into the daily aggregates,
+        and aggregate again the days specified, when their connections have been modified"""
+        days = set(days or [])
 
-        ispReport = []
+        try:
+            row = self.execute('lastRowid').fetchone()
+            lastRowid = row[0] if row else 0
+            maxRowid = self.execute('maxRowid').fetchone()[0]
 
-        for row in cursor:
-            line = {}
-            line['isp'] = row[0]
-            line['country'] = row[1]
-            line['nbConnections'] = row[2]
-            line['from-date'] = row[3]
-            line['till-date'] = row[4]
-            ispReport.append(line)
+            # The database has been emptied or replaced, aggregate everything again
+            if maxRowid < lastRowid:
+                lastRowid = 0
+                self.execute('clearRollup')
 
-        return ispReport
+            self.aggregateDays(days)
+            groups = self.foldNewConnections(lastRowid, days)
 
-    # List by country
-    def reportByCountry(self):
-        """Return per country statistics"""
-        condition = "unixtime > '{}%' and countryName != '-'".format(self.periodFilter)
-        timeColumns = "count(ip) as count," + self.dateColumns
-        group = "group by countryName"
-        order = "order by count desc"
-        query = "select countryName,{} from connections where {} {} {}".format(
-            timeColumns, condition, group, order)
-        cursor = self.conn.execute(query)
+            # The old connections are removed from the log, remove their aggregates too
+            firstDay = self.execute('firstDay').fetchone()[0]
+            if firstDay is not None:
+                self.execute('pruneRollup', firstDay)
 
-        countryReport = []
+            self.execute('clearState')
+            self.execute('setLastRowid', maxRowid)
+            self.conn.commit()
 
-        for row in cursor:
-            line = {}
-            line['country'] = row[0]
-            line['nbConnections'] = row[1]
-            line['from-date'] = row[2]
-            line['till-date'] = row[3]
-            countryReport.append(line)
+        except Exception:
+            raise DatabaseAccessError("Could not update the database '{}'"
+                                      .format(self.connLogFile))
 
-        return countryReport
+        logging.info("Aggregated {} day(s) again, and {} new group(s) of connections"
+                     .format(len(days), groups))
+
+    def reports(self):
+        """Compute all the reports in one pass over the aggregates of the period,
+        and return them by template variable name"""
+        providers = {}
+        providerCountries = {}
+        countries = {}
+        sources = {}
+        statuses = {}
+        hours = [0] * 24
+
+        for hour, country, provider, source, status, ip, count, firstSeen, lastSeen in self.execute(
+                'reports', self.periodStart, self.periodEnd):
+            hours[hour] += count
+
+            # Same exclusions as the SQL conditions, the null values are ignored
+            if provider is not None and provider != 'private':
+                self.addToGroup(providers, provider, count, firstSeen, lastSeen)
+                countryCounts = providerCountries.setdefault(provider, {})
+                countryCounts[country] = countryCounts.get(country, 0) + count
+            if country is not None and country != '-':
+                self.addToGroup(countries, country, count, firstSeen, lastSeen)
+            if source is not None and source != '-':
+                self.addToGroup(sources, source, count, firstSeen, lastSeen)
+            if status is not None and status != 'OK':
+                self.addToGroup(statuses, (status, ip), count, firstSeen, lastSeen)
+
+        # List by ISP (Internet Service Provider), with its most frequent country
+        ispReport = []
+        for provider, line in self.sortGroup(providers):
+            countryCounts = providerCountries[provider]
+            line['isp'] = provider
+            line['country'] = max(countryCounts, key=countryCounts.get)
+            ispReport.append(line)
 
-    # List by client source
-    def reportBySource(self):
-        """Return access report by client source (imap, roundcube, ...)"""
-        condition = "unixtime > '{}%' and source != '-'".format(self.periodFilter)
-        timeColumns = "count(ip) as count," + self.dateColumns
-        group = "group by source"
-        order = "order by count desc"
-        query = "select source,{} from connections where {} {} {}".format(
-            timeColumns, condition, group, order)
-        cursor = self.conn.execute(query)
+        # List by country
+        countryReport = []
+        for country, line in self.sortGroup(countries):
+            line['country'] = country
+            countryReport.append(line)
 
+        # List by client source (imap, roundcube, ...)
         sourceReport = []
-
-        for row in cursor:
-            line = {}
-            line['source'] = row[0]
-            line['nbConnections'] = row[1]
-            line['from-date'] = row[2]
-            line['till-date'] = row[3]
+        for source, line in self.sortGroup(sources):
+            line['source'] = source
             sourceReport.append(line)
 
-        return sourceReport
-
-
-    # List by status
-    def reportByStatus(self):
-        """Return access by status OK, Warning, Error"""
-        condition = "unixtime > '{}%' and status != 'OK'".format(self.periodFilter)
-        timeColumns = "count(ip) as count," + self.dateColumns
-        group = "group by status,ip"
-        order = "order by count desc"
-        query = "select status,ip,{} from connections where {} {} {}".format(
-            timeColumns, condition, group, order)
-        cursor = self.conn.execute(query)
-
+        # List by status and IP address, except OK
         statusReport = []
+        for (status, ip), line in self.sortGroup(statuses):
+            line['status'] = status
+            line['ip'] = ip
+            statusReport.append(line)
 
-        for row in cursor:
+        # List by hour, scaled from 0 to 20, only when there are connections
+        hourReport = None
+        maxCon = max(hours)
+        if maxCon != 0:
+            hourReport = [{'hour': hour, 'count': int(20 * count / maxCon)} for hour, count in enumerate(hours)]
+
+        return {'ispReport': ispReport,
+                'countryReport': countryReport,
+                'sourceReport': sourceReport,
+                'statusReport': statusReport,
+                'hourReport': hourReport}
+
+    @staticmethod
+    def addToGroup(group, key, count, firstSeen, lastSeen):
+        """Add the aggregated connections to the count, first and last times of a group"""
+        entry = group.get(key)
+        if entry is None:
+            group[key] = [count, firstSeen, lastSeen]
+        else:
+            entry[0] += count
+            entry[1] = min(entry[1], firstSeen)
+            entry[2] = max(entry[2], lastSeen)
+
+    def sortGroup(self, group):
+        """Return the report lines of a group, by decreasing number of connections"""
+        lines = []
+        for key, entry in sorted(group.items(), key=lambda item: item[1][0], reverse=True):
             line = {}
-            line['status'] = row[0]
-            line['ip'] = row[1]
-            line['nbConnections'] = row[2]
-            line['from-date'] = row[3]
-            line['till-date'] = row[4]
-            statusReport.append(line)
+            line['nbConnections'] = entry[0]
+            line['from-date'] = self.formatDate(entry[1])
+            line['till-date'] = self.formatDate(entry[2])
+            lines.append((key, line))
+        return lines
+
+    def formatDate(self, timestamp):
+        """Format a connection time, according to the period"""
+        return datetime.datetime.strptime(timestamp[:19], "%Y-%m-%d %H:%M:%S").strftime(self.dateFormat)
+
+
+class ConnectionStore(object):
+    """Consolidated store of the connections of all the users, in one WAL database.
+    The connections and the aggregates are partitioned by user id and time, and
+    imported from the database of each user, from the last connection imported."""
+
+    SCHEMA = [
+        "create table if not exists users (id INTEGER PRIMARY KEY, name VARCHAR UNIQUE)",
+        "create table if not exists countries (id INTEGER PRIMARY KEY, code CHAR(2), name VARCHAR, UNIQUE (code, name))",
+        "create table if not exists providers (id INTEGER PRIMARY KEY, name VARCHAR UNIQUE)",
+        "create table if not exists sources (id INTEGER PRIMARY KEY, name VARCHAR UNIQUE)",
+        "create table if not exists statuses (id INTEGER PRIMARY KEY, name VARCHAR UNIQUE)",
+        "create table if not exists connections_log ("
+        " uid INTEGER REFERENCES users, id INTEGER, time INTEGER, ip VARCHAR,"
+        " country INTEGER REFERENCES countries, provider INTEGER REFERENCES providers,"
+        " source INTEGER REFERENCES sources, status INTEGER REFERENCES statuses,"
+        " mobile BOOLEAN DEFAULT NULL, type CHAR(10) DEFAULT NULL,"
+        " score SMALLINT DEFAULT 0, details TEXT DEFAULT '',"
+        " PRIMARY KEY (uid, id)) WITHOUT ROWID",
+        "create index if not exists log_period_idx on connections_log"
+        " (uid, time, country, provider, source, status, ip)",
+        "create index if not exists log_provider_idx on connections_log (uid, provider, ip, time)",
+        "create table if not exists connections_rollup ("
+        " uid INTEGER, day DATE, hour INTEGER, countryName VARCHAR, provider VARCHAR,"
+        " source VARCHAR, status CHAR(10), ip VARCHAR, count INTEGER,"
+        " firstSeen TIMESTAMP, lastSeen TIMESTAMP)",
+        "create index if not exists rollup_covering_idx on connections_rollup"
+        " (uid, day, hour, ip, source, status, provider, countryName, count, firstSeen, lastSeen)",
+        "create index if not exists rollup_fleet_idx on connections_rollup"
+        " (day, hour, ip, source, status, provider, countryName, count, firstSeen, lastSeen)",
+        "create table if not exists rollup_state (uid INTEGER PRIMARY KEY, lastRowid INTEGER)",
+        "create table if not exists load_state (uid INTEGER PRIMARY KEY, lastRowid INTEGER)",
+    ]
+
+    def __init__(self, path):
+        self.path = path
+        self.dictionaries = {}
 
-        return statusReport
+        try:
+            self.conn = sqlite3.connect(path)
+            self.conn.execute("pragma journal_mode=wal")
+            for statement in self.SCHEMA:
+                self.conn.execute(statement)
+            self.conn.commit()
+        except Exception:
+            raise DatabaseAccessError("Could not open the connections store '{}'".format(path))
+
+    def userId(self, user):
+        """Return the id of a user in the store, added and committed with the first use,
+        so the reports do not leave a transaction opened"""
+        row = self.conn.execute("select id from users where name = ?", (user, )).fetchone()
+        if row is None:
+            self.conn.execute("insert or ignore into users (name) values (?)", (user, ))
+            self.conn.commit()
+            row = self.conn.execute("select id from users where name = ?", (user, )).fetchone()
+        return row[0]
+
+    def dictionaryId(self, table, *values):
+        """Return the id of a value in one of the dictionary tables, None for the null values"""
+        if values[-1] is None:
+            return None
+
+        key = (table, ) + values
+        if key not in self.dictionaries:
+            if table == 'countries':
+                self.conn.execute("insert or ignore into countries (code, name) values (?, ?)", values)
+                row = self.conn.execute("select id from countries where code is ? and name = ?", values).fetchone()
+            else:
+                self.conn.execute("insert or ignore into {} (name) values (?)".format(table), values)
+                row = self.conn.execute("select id from {} where name = ?".format(table), values).fetchone()
+            self.dictionaries[key] = row[0]
+
+        return self.dictionaries[key]
+
+    def lastImported(self, user):
+        """Return the id of the last connection of a user imported in the store, with its time and address,
+        to check the connection is still the same in the database of the user"""
+        row = self.conn.execute("select s.lastRowid, l.time, l.ip from load_state s"
+                                " join users on users.id = s.uid"
+                                " left join connections_log l on l.uid = s.uid and l.id = s.lastRowid"
+                                " where users.name = ?", (user, )).fetchone()
+        return tuple(row) if row else (0, None, None)
+
+    def load(self, user, minRowid, maxRowid, rows, reloaded):
+        """Import the connections read from the database of a user since the last import,
+        and remove the connections pruned. When the database of the user has been replaced,
+        all its connections have been read again. Return the number of connections imported"""
+        uid = self.userId(user)
 
-    # List by hour
-    def reportByHour(self):
-        """Return statistics per hour of the day"""
-        condition = "unixtime > '{}%'".format(self.periodFilter)
-        timeColumns = "strftime('%H', unixtime) as hour,count(*) as count"
-        group = "group by hour"
-        order = "order by hour"
-        query = "select {} from connections where {} {} {}".format(
-            timeColumns, condition, group, order)
-        cursor = self.conn.execute(query)
+        try:
+            # The database has been emptied or replaced, import everything again
+            if reloaded:
+                for table in ('connections_log', 'connections_rollup', 'rollup_state'):
+                    self.conn.execute("delete from {} where uid = ?".format(table), (uid, ))
+
+            # The old connections are removed from the database of the user
+            self.conn.execute("delete from connections_log where uid = ? and id < ?", (uid, minRowid))
+
+            for position in range(0, len(rows), 1000):
+                self.conn.executemany("insert into connections_log values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                      [(uid, rowid, time, ip, self.dictionaryId('countries', code, name),
+                                        self.dictionaryId('providers', provider),
+                                        self.dictionaryId('sources', sourceName),
+                                        self.dictionaryId('statuses', status), mobile, connType, score, details)
+                                       for rowid, time, ip, code, name, provider, sourceName, status,
+                                       mobile, connType, score, details in rows[position:position + 1000]])
+
+            self.conn.execute("insert or replace into load_state values (?, ?)", (uid, maxRowid))
+            self.conn.commit()
 
-        # First pass, get the max value
-        hourReport = None
-        maxCon = 0
-        for row in cursor:
-            maxCon = max(maxCon, row[1])
+        except Exception:
+            self.conn.rollback()
+            self.dictionaries = {}
+            raise DatabaseAccessError("Could not import the connections of user {} in '{}'"
+                                      .format(user, self.path))
+
+        logging.info("Imported {} connection(s) of user {}".format(len(rows), user))
+        return len(rows)
+
+class ConsolidatedReportBuilder(ReportBuilder):
+    """Build a report for a specific user, from the consolidated store.
+    Same queries as the database of the user, in the partition of the user."""
+
+    # The first parameter of each query is the user id
+    QUERIES = {
+        'nbConnections':
+            "select count(*) from connections_log where uid = ?1 and time >= ?2 and time < ?3",
+        'unresolvedAddresses':
+            "select distinct ip from connections_log where uid = ?1 and provider is null",
+        'unresolvedDays':
+            "select distinct date(time, 'unixepoch') from connections_log where uid = ?1 and provider is null",
+        'setProvider':
+            "update connections_log set provider = (select id from providers where name = ?2)"
+            " where uid = ?1 and ip = ?3 and provider is null",
+        'aggregateDay':
+            "select " + AGGREGATE_COLUMNS + " where l.uid = ?1 and l.time >= ?2 and l.time < ?3" + AGGREGATE_GROUPS,
+        'insertDay':
+            "insert into connections_rollup"
+            " select ?1, " + AGGREGATE_COLUMNS + " where l.uid = ?1 and l.time >= ?2 and l.time < ?3" + AGGREGATE_GROUPS,
+        'deleteDay':
+            "delete from connections_rollup where uid = ?1 and day = ?2",
+        'newConnections':
+            "select " + AGGREGATE_COLUMNS + " where l.uid = ?1 and l.id > ?2" + AGGREGATE_GROUPS,
+        'updateGroup':
+            "update connections_rollup set count = count + ?2, firstSeen = min(firstSeen, ?3), lastSeen = max(lastSeen, ?4)"
+            " where uid = ?1 and day = ?5 and hour = ?6 and ip is ?7 and source is ?8 and status is ?9"
+            " and provider is ?10 and countryName is ?11",
+        'insertGroup':
+            "insert into connections_rollup values (?1, ?2, ?3, ?4, ?5, ?6, ?7, ?8, ?9, ?10, ?11)",
+        'lastRowid':
+            "select lastRowid from rollup_state where uid = ?1",
+        'maxRowid':
+            "select coalesce(max(id), 0) from connections_log where uid = ?1",
+        'setLastRowid':
+            "insert into rollup_state values (?1, ?2)",
+        'clearState':
+            "delete from rollup_state where uid = ?1",
+        'clearRollup':
+            "delete from connections_rollup where uid = ?1",
+        'firstDay':
+            "select date(min(time), 'unixepoch') from connections_log where uid = ?1",
+        'pruneRollup':
+            "delete from connections_rollup where uid = ?1 and day < ?2",
+        'reports':
+            "select hour, countryName, provider, source, status, ip, count, firstSeen, lastSeen"
+            " from connections_rollup where uid = ?1 and day >= ?2 and day < ?3",
+    }
+
+    def __init__(self, user, period, store):
+        self.mail = "{}".format(user)
+        self.connLogFile = store.path
+        self.sendReport = False
+        self.period = period
+        self.conn = store.conn
+        self.version = NORMALISED_VERSION
+        self.scope = (store.userId(user), )
+        self.initPeriod(period)
+
+
+class FleetReportBuilder(ReportBuilder):
+    """Build a report for all the users at once, from the aggregates of the consolidated store"""
+
+    QUERIES = {
+        'nbConnections':
+            "select coalesce(sum(count), 0) from connections_rollup where day >= ? and day < ?",
+        'reports':
+            "select hour, countryName, provider, source, status, ip, count, firstSeen, lastSeen"
+            " from connections_rollup where day >= ? and day < ?",
+    }
+
+    def __init__(self, period, store):
+        self.mail = "all users"
+        self.connLogFile = store.path
+        self.sendReport = False
+        self.period = period
+        self.conn = store.conn
+        self.version = NORMALISED_VERSION
+        self.scope = ()
+        self.initPeriod(period)
 
-        # Build the hour report only if required
-        if maxCon != 0:
+    def nbConnections(self):
+        """Return the number of connections of all the users for this period"""
+        return self.execute('nbConnections', self.periodStart, self.periodEnd).fetchone()[0]
 
-            # Initialise the hour report to an array with all possible hours
-            hourReport = []
-            for h in range(0, 24):
-                empty = { 'hour': h, 'count': 0 }
-                hourReport.append(empty)
 
-            cursor = self.conn.execute(query)
-            for row in cursor:
-                line = {}
-                hour = int(row[0])
-                line['hour'] = hour
-                line['count'] = int(20 * int(row[1]) / maxCon)
-                hourReport[hour] = line
+# Settings of the users receiving a report, for the batch mode
+USERS_SETTINGS_PATH = "/etc/homebox/access-report.d/users.conf"
 
-        return hourReport
+# Report templates, by format
+TEMPLATE_PATHS = {
+    'text': "/etc/homebox/access-report.d/monthly-report.text.j2",
+    'html': "/etc/homebox/access-report.d/monthly-report.html.j2",
+}
 
+# Name of each period in the users settings
+PERIOD_SETTINGS = {
+    Period.lastWeek: 'week',
+    Period.lastMonth: 'month',
+    Period.lastYear: 'year',
+}
 
-def main(args):
 
-    import jinja2
-    import smtplib
-    from email.mime.text import MIMEText
-    from email.mime.multipart import MIMEMultipart
-
-    # Create the period name
+def periodNames(period):
+    """Return the name and the title of the period"""
     day = datetime.date.today()
-    if args.period == Period.lastWeek:
+    if period == Period.lastWeek:
         lastWeek = day - datetime.timedelta(days=7)
         periodName = lastWeek.strftime("%d/%m/%Y")
         periodTitle = "Weekly"
-    elif args.period == Period.lastMonth:
+    elif period == Period.lastMonth:
         day = day.replace(day=1)
         lastMonth = day - datetime.timedelta(days=1)
         periodName = lastMonth.strftime("%m/%Y")
         periodTitle = "Monthly"
-    elif args.period == Period.lastYear:
+    elif period == Period.lastYear:
         day = day.replace(day=1)
         day = day.replace(month=1)
         lastYear = day - datetime.timedelta(days=1)
@@ -277,62 +948,251 @@ def main(args):
         periodName = "Beginning of time"
         periodTitle = "Full"
 
-    user = None
-    if args.user:
-        user = args.user
+    return periodName, periodTitle
+
+
+def loadTemplates(formats):
+    """Compile the templates of the formats to send, once for all the reports"""
+    import jinja2
+
+    templates = {}
+    for mailFormat in ('text', 'html'):
+        if mailFormat in formats:
+            try:
+                with open(TEMPLATE_PATHS[mailFormat]) as tmplFile:
+                    templates[mailFormat] = jinja2.Template(tmplFile.read())
+            except Exception:
+                raise TemplateError()
+
+    return templates
+
+
+def switchUser(user):
+    """When started as root, switch to the user, the database belongs to the user"""
+    if os.geteuid() == 0:
+        account = pwd.getpwnam(user)
+        os.setgroups([])
+        os.setgid(account.pw_gid)
+        os.setuid(account.pw_uid)
+
+
+def hasDatabase(user):
+    """Check if a user has a connections database, once switched to the user"""
+    return os.path.exists("/home/users/{}/security/imap-connections.db".format(user))
+
+
+def listUsers():
+    """Return the users with a home folder. The security folders can only be read by their owner,
+    so the connections databases are only opened by the processes switched to each user."""
+    return sorted(entry.name for entry in os.scandir("/home/users") if entry.is_dir())
+
+
+def runAsUsers(function, users, *args):
+    """Call the function for each user, in a separate process switching to the user when
+    started as root, and yield the (user, result, error) tuples in the order of the users"""
+    import multiprocessing
+
+    pool = multiprocessing.Pool(maxtasksperchild=1)
+    pending = [(user, pool.apply_async(function, (user, ) + args)) for user in users]
+    pool.close()
+
+    for user, result in pending:
+        try:
+            yield user, result.get(), None
+        except Exception as error:
+            yield user, None, error
+    pool.join()
+
+
+def migrateDatabase(user):
+    """Apply the schema migrations to the database of a user, and return its version,
+    or None when the user has no database"""
+    switchUser(user)
+    if not hasDatabase(user):
+        return None
+    return ReportBuilder(user, Period.beginning).version
+
+
+def migrateDatabases(args):
+    """Apply the schema migrations to the database of the user, or of all the users"""
+    if args.allUsers:
+        users = listUsers()
     else:
         import getpass
-        user = getpass.getuser()
+        users = [args.user or getpass.getuser()]
+
+    failures = 0
+    for user, version, error in runAsUsers(migrateDatabase, users):
+        if error is not None:
+            logging.error("Could not migrate the database of user {}: {}".format(user, error))
+            failures += 1
+        elif version is not None:
+            print("{}: version {}".format(user, version))
+
+    if failures:
+        sys.exit(1)
+
+
+def readConnections(user, lastImported):
+    """Return the first and last ids of the connections of a user, with the connections after
+    the last one imported in the store, and whether all the connections have been read again,
+    or None when the user has no database to import yet.
+    When started as root, switch to the user first, the database can only be read by the user."""
+    switchUser(user)
+    if not hasDatabase(user):
+        return None
+
+    connLogFile = "/home/users/{}/security/imap-connections.db".format(user)
+    try:
+        source = sqlite3.connect("file:{}?mode=ro".format(connLogFile), uri=True)
+        version = source.execute("pragma user_version").fetchone()[0]
+    except Exception:
+        raise DatabaseAccessError("Could not open the database '{}'".format(connLogFile))
+
+    try:
+        if version < NORMALISED_VERSION:
+            logging.warning("The database of user {} is not migrated yet".format(user))
+            return None
+
+        lastRowid, lastTime, lastIp = lastImported.get(user, (0, None, None))
+        minRowid, maxRowid = source.execute("select coalesce(min(id), 0), coalesce(max(id), 0)"
+                                            " from connections_log").fetchone()
+
+        # The database has been emptied or replaced when the last connection imported is not there anymore,
+        # its ids start again: read everything again
+        reloaded = lastRowid > 0 and source.execute("select time, ip from connections_log where id = ?",
+                                                    (lastRowid, )).fetchone() != (lastTime, lastIp)
+        rows = source.execute("select l.id, l.time, l.ip, countries.code, countries.name, providers.name,"
+                              " sources.name, statuses.name, l.mobile, l.type, l.score, l.details"
+                              " from connections_log l"
+                              " left join countries on countries.id = l.country"
+                              " left join providers on providers.id = l.provider"
+                              " left join sources on sources.id = l.source"
+                              " left join statuses on statuses.id = l.status"
+                              " where l.id > ?", (0 if reloaded else lastRowid, )).fetchall()
+        return minRowid, maxRowid, rows, reloaded
+
+    finally:
+        source.close()
+
+
+def unresolvedAddresses(user):
+    """Return the addresses of a user without provider, as the user, like the reports"""
+    switchUser(user)
+    if not hasDatabase(user):
+        return []
+    return ReportBuilder(user, Period.beginning, readOnly=True).unresolvedAddresses()
+
+
+def buildReports(user, period, settingsPath=None):
+    """Build the reports of a user, or return None when there is no connection for this period.
+    When started as root, switch to the user first, the database belongs to the user."""
+    switchUser(user)
+    if not hasDatabase(user):
+        return None
+
+    reportBuilder = ReportBuilder(user, period)
+    if reportBuilder.nbConnections() == 0:
+        return None
 
-    # The final recipient of the email.
-    # When not specified, it will be the user
-    recipient = None
-    if args.recipient:
-        recipient = args.recipient
-    else:
-        recipient = user
+    # Update providers when they have not been updated
+    reportBuilder.updateProviders(ProviderResolver(settingsPath))
+
+    # Aggregate the new connections
+    reportBuilder.updateRollup()
+
+    # Load statistics, all the reports at once
+    return reportBuilder.reports()
+
+
+def openStore(settingsPath=None):
+    """Open the consolidated store when enabled in the settings, or return None"""
+    settings = readSettings(settingsPath)
+    if not settings.getboolean('store', 'consolidated', fallback=False):
+        return None
+    return ConnectionStore(settings.get('store', 'path', fallback=STORE_PATH))
 
-    # Format to use to send the email
-    includeText = True
-    includeHtml = True
-    if args.mailFormat:
-        includeText = "text" in args.mailFormat
-        includeHtml = "html" in args.mailFormat
 
-    reportBuilder = ReportBuilder(user, args.period)
+def updateStore(store, settingsPath=None):
+    """Import the new connections of all the users in the consolidated store,
+    then resolve their providers and update their aggregates"""
+    resolver = ProviderResolver(settingsPath)
+    users = listUsers()
+    lastImported = dict((user, store.lastImported(user)) for user in users)
+
+    # The databases are read as each user, and imported one at a time
+    for user, connections, error in runAsUsers(readConnections, users, lastImported):
+        if error is not None:
+            logging.error("Could not read the connections of user {}: {}".format(user, error))
+            continue
+        if connections is None:
+            continue
+
+        try:
+            store.load(user, *connections)
+            reportBuilder = ConsolidatedReportBuilder(user, Period.beginning, store)
+            reportBuilder.updateProviders(resolver)
+            reportBuilder.updateRollup()
+        except Exception as error:
+            logging.error("Could not update the connections of user {} in the store: {}".format(user, error))
+
+
+def buildStoreReports(store, user, period):
+    """Build the reports of a user from the consolidated store, or return None
+    when there is no connection for this period"""
+    reportBuilder = ConsolidatedReportBuilder(user, period, store)
     if reportBuilder.nbConnections() == 0:
-        print("No connections for this period ({})".format(periodName))
+        return None
+    return reportBuilder.reports()
+
+
+def fleetReport(args):
+    """Send the report of the connections of all the users, from the consolidated store"""
+    import smtplib
+
+    store = openStore(args.settings)
+    if store is None:
+        print("The consolidated store is not enabled in {}".format(args.settings or SETTINGS_PATH))
+        sys.exit(1)
+
+    updateStore(store, args.settings)
+
+    reportBuilder = FleetReportBuilder(args.period, store)
+    if reportBuilder.nbConnections() == 0:
+        print("No connections for this period ({})".format(periodNames(args.period)[0]))
         sys.exit()
 
-    # Update providers when they have not been updated
-    reportBuilder.updateProviders()
+    formats = ['text', 'html']
+    if args.mailFormat:
+        formats = [mailFormat for mailFormat in formats if mailFormat in args.mailFormat]
+
+    recipient = args.recipient or "postmaster"
+    message = createMessage(loadTemplates(formats), reportBuilder.mail, recipient,
+                            args.period, reportBuilder.reports())
+
+    server = smtplib.SMTP("localhost", 587)
+    try:
+        server.sendmail("postmaster", recipient, message.as_string())
+    finally:
+        server.quit()
+
+
+def createMessage(templates, user, recipient, period, reports):
+    """Render the reports with the templates, and return the email message"""
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
 
-    # Load statistics
-    ispReport = reportBuilder.reportByProvider()
-    countryReport = reportBuilder.reportByCountry()
-    sourceReport = reportBuilder.reportBySource()
-    statusReport = reportBuilder.reportByStatus()
-    hourReport = reportBuilder.reportByHour()
+    periodName, periodTitle = periodNames(period)
 
     # Initialise the mime message
     message = MIMEMultipart("alternative")
 
     # Create the text template
-    if includeText:
+    if 'text' in templates:
         logging.info("Generating a text access report for user {}".format(user))
 
-        textTemplatePath = "/etc/homebox/access-report.d/monthly-report.text.j2"
-
         try:
-            with open(textTemplatePath) as tmplFile:
-                template = jinja2.Template(tmplFile.read())
-
-                text = template.render(ispReport=ispReport,
-                                       countryReport=countryReport,
-                                       sourceReport=sourceReport,
-                                       statusReport=statusReport,
-                                       hourReport=hourReport).replace("_", " ")
-
+            text = templates['text'].render(**reports).replace("_", " ")
         except Exception:
             raise TemplateError()
 
@@ -342,20 +1202,11 @@ def main(args):
         logging.info("Generated text message")
 
     # Create the HTML template
-    if includeHtml:
+    if 'html' in templates:
         logging.info("Generating an HTML access report for user {}".format(user))
 
-        htmlTemplatePath = "/etc/homebox/access-report.d/monthly-report.html.j2"
-
         try:
-            with open(htmlTemplatePath) as tmplFile:
-                template = jinja2.Template(tmplFile.read())
-
-                html = template.render(ispReport=ispReport,
-                                       countryReport=countryReport,
-                                       sourceReport=sourceReport,
-                                       statusReport=statusReport,
-                                       hourReport=hourReport)
+            html = templates['html'].render(**reports)
         except Exception:
             raise TemplateError()
 
@@ -369,9 +1220,144 @@ def main(args):
     message["From"] = "postmaster"
     message["To"] = recipient
 
+    return message
+
+
+def allUsers(args):
+    """Build the reports of all the users in parallel, and send them in one SMTP session"""
+    import smtplib
+    import configparser
+
+    # Users receiving a report for this period, with their settings
+    settings = configparser.RawConfigParser()
+    settings.read(USERS_SETTINGS_PATH)
+
+    users = []
+    for user in listUsers():
+        if settings.has_section(user):
+            periods = settings.get(user, 'periods', fallback='week,month,year').split(',')
+            if PERIOD_SETTINGS.get(args.period) in [period.strip() for period in periods]:
+                users.append(user)
+
+    # Compile the templates once, for all the formats used
+    formats = set()
+    for user in users:
+        formats.update(settings.get(user, 'format', fallback='text,html').split(','))
+    templates = loadTemplates(formats)
+
+    results = []
+    store = openStore(args.settings)
+    if store is not None:
+        # All the reports are read from the consolidated store, with the same connection
+        updateStore(store, args.settings)
+        for user in users:
+            try:
+                results.append((user, buildStoreReports(store, user, args.period), None))
+            except Exception as error:
+                results.append((user, None, error))
+
+    else:
+        # Resolve the providers of all the users at once, the workers find them in the shared cache
+        addresses = set()
+        for user, userAddresses, error in runAsUsers(unresolvedAddresses, users):
+            if error is not None:
+                logging.warning("Could not read the addresses of user {}: {}".format(user, error))
+            else:
+                addresses.update(userAddresses)
+        if addresses:
+            ProviderResolver(args.settings).resolve(sorted(addresses))
+
+        # One process per user, switching to the user when started as root
+        results = list(runAsUsers(buildReports, users, args.period, args.settings))
+
+    messages = []
+    for user, reports, error in results:
+        if error is not None:
+            logging.error("Could not build the access report for user {}: {}".format(user, error))
+            continue
+
+        if reports is None:
+            logging.info("No connections for user {} for this period".format(user))
+            continue
+
+        userFormats = settings.get(user, 'format', fallback='text,html')
+        userTemplates = dict((mailFormat, template) for mailFormat, template in templates.items()
+                             if mailFormat in userFormats)
+        recipient = settings.get(user, 'recipient', fallback=user)
+        messages.append((recipient, createMessage(userTemplates, user, recipient, args.period, reports)))
+
+    # Send all the reports with the same connection
+    if messages:
+        server = smtplib.SMTP("localhost", 587)
+        try:
+            for recipient, message in messages:
+                server.sendmail("postmaster", recipient, message.as_string())
+        finally:
+            server.quit()
+
+    logging.info("Sent {} access report(s)".format(len(messages)))
+
+
+def main(args):
+
+    import smtplib
+
+    if args.migrate:
+        migrateDatabases(args)
+        return
+
+    if args.load:
+        store = openStore(args.settings)
+        if store is None:
+            print("The consolidated store is not enabled in {}".format(args.settings or SETTINGS_PATH))
+            sys.exit(1)
+        updateStore(store, args.settings)
+        return
+
+    if args.fleet:
+        fleetReport(args)
+        return
+
+    if args.allUsers:
+        allUsers(args)
+        return
+
+    if args.resolve:
+        providers = ProviderResolver(args.settings).resolve(args.resolve)
+        for ip in args.resolve:
+            print("{}\t{}".format(ip, providers.get(ip, '')))
+        return
+
+    user = None
+    if args.user:
+        user = args.user
+    else:
+        import getpass
+        user = getpass.getuser()
+
+    # The final recipient of the email.
+    # When not specified, it will be the user
+    recipient = None
+    if args.recipient:
+        recipient = args.recipient
+    else:
+        recipient = user
+
+    # Format to use to send the email
+    formats = ['text', 'html']
+    if args.mailFormat:
+        formats = [mailFormat for mailFormat in formats if mailFormat in args.mailFormat]
+
+    reports = buildReports(user, args.period, args.settings)
+    if reports is None:
+        print("No connections for this period ({})".format(periodNames(args.period)[0]))
+        sys.exit()
+
+    message = createMessage(loadTemplates(formats), user, recipient, args.period, reports)
+
     # Create secure connection with server and send email
     server = smtplib.SMTP("localhost", 587)
-    server.sendmail("postmaster", user, message.as_string())
+    server.sendmail("postmaster", recipient, message.as_string())
 
 ################################################################################
 # parse arguments, build the manager, and call it
@@ -400,14 +1386,57 @@ parser.add_argument(
     dest="mailFormat",
     required=False)
 
+# Build and send the reports of all the users, from the users settings
+parser.add_argument(
+    '--all-users',
+    help="Send the reports of all the users configured in {}".format(USERS_SETTINGS_PATH),
+    dest="allUsers",
+    action='store_true')
+
+# Migrate the databases to the last layout, of the user or all the users
+parser.add_argument(
+    '--migrate',
+    help="Apply the schema migrations to the connections database, and exit",
+    action='store_true')
+
+# Import the new connections of all the users in the consolidated store
+parser.add_argument(
+    '--load',
+    help="Import the new connections of all the users in the consolidated store, and exit",
+    action='store_true')
+
+# Report of the connections of all the users, sent to the postmaster by default
+parser.add_argument(
+    '--fleet',
+    help="Send the report of the connections of all the users, from the consolidated store",
+    action='store_true')
+
+# Settings file, for the providers resolution and the consolidated store
+parser.add_argument(
+    '--settings',
+    type=str,
+    help="The settings file to use, {} by default".format(SETTINGS_PATH),
+    required=False)
+
+# Resolve the providers of some IP addresses, e.g. to check the settings
+parser.add_argument(
+    '--resolve',
+    type=str,
+    nargs='+',
+    metavar='IP',
+    help="Display the providers of the IP addresses, and exit",
+    required=False)
+
 # The period to consider: last month or last year
 parser.add_argument(
     '--period',
     type=Period,
     help="The period to use: last-month by default.",
     choices=list(Period),
+    default=Period.lastMonth,
     required=False)
 
 
 # Call the entry point
-main(parser.parse_args())
+if __name__ == '__main__':
+    main(parser.parse_args())
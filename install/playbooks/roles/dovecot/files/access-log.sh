@@ -66,10 +66,22 @@ if [ ! -f "$connLogFile" ]; then
     exit $CONTINUE
 fi
 
+# Since the version 3 of the database, the connections are stored in the connections_log table,
+# with integer keys and times in seconds since the epoch. The databases are migrated by access-report.py,
+# and the connections view inserts the new rows in both layouts.
+# The layout read here is only used to skip the connections already logged, the writes read it again
+layout=$(sqlite3 -batch "$connLogFile" "pragma user_version")
+
 # Check if already logged in from this IP in the last minute
-isoLastMinute=$(date -d '1 min ago' --rfc-3339=seconds | sed 's/+.*//')
-condition="unixtime >= '$isoLastMinute' AND source='$SOURCE' AND ip='$IP'"
-query="select count(*) from connections where $condition"
+if [ "0$layout" -ge 3 ]; then
+    lastMinute=$(date -d '1 min ago' +%s)
+    condition="time >= $lastMinute AND source=(select id from sources where name='$SOURCE') AND ip='$IP'"
+    query="select count(*) from connections_log where $condition"
+else
+    isoLastMinute=$(date -d '1 min ago' --rfc-3339=seconds | sed 's/+.*//')
+    condition="unixtime >= '$isoLastMinute' AND source='$SOURCE' AND ip='$IP'"
+    query="select count(*) from connections where $condition"
+fi
 
 count=$(sqlite3 -batch "$connLogFile" "$query")
 
@@ -132,11 +144,27 @@ fi
 # Prepare the query, and insert the connection record
 columns='ip, countryCode, countryName, provider, source, status, score, details'
 values="'$IP','$countryCode','$countryName','$isp', '$SOURCE','$STATUS', '$SCORE','$smallDetails'"
-command="insert into connections ($columns) VALUES ($values);"
-
-sqlite3 -batch "$connLogFile" "$command"
 
 # While we are here, let's do some cleanup and keep one year only
+lastYear=$(date -d '1 year ago' +%s)
 isoLastYear=$(date -d '1 year ago' --rfc-3339=seconds | sed 's/+.*//')
-query="delete from connections where unixtime <= '$isoLastYear'"
-sqlite3 -batch "$connLogFile" "$query"
+
+# Insert and clean up in one session and transaction, where the layout is read again, so a migration
+# cannot happen in between. The insert works with both layouts, and the cleanup statement of the
+# current layout is written by the session in a file, then read by the same session.
+cleanupFile="$secdir/$ipSig.sql"
+trap 'rm -f $lockFile $cleanupFile' EXIT
+
+sqlite3 -batch -bail "$connLogFile" <<EOF
+.timeout 5000
+begin immediate;
+insert into connections ($columns) values ($values);
+.output $cleanupFile
+select case when user_version >= 3
+    then 'delete from connections_log where time <= $lastYear;'
+    else 'delete from connections where unixtime <= ''$isoLastYear'';'
+    end from pragma_user_version;
+.output stdout
+.read $cleanupFile
+commit;
+EOF
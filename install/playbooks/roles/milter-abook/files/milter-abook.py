@@ -0,0 +1,1683 @@
+#!/usr/bin/env python3
+
+# Search inside the recipients address books to check if the message is coming
+# from a known email address, and tag the message with the address books found.
+# I use http://bmsi.com/python/milter.html
+# The address books are searched using backends, selected in the configuration file:
+# - sogo: the SOGo contacts, stored in PostgreSQL
+# - roundcube: the Roundcube contacts, stored in PostgreSQL
+# - sqlite: a local database, storing only the email address signatures,
+#   synchronised from the other backends with the --sync option
+# The same process can search in several backends.
+
+# Andre Rodier <andre@rodier.me>
+# Licence: GPL v2
+
+# Pylint options
+# too long lines: pylint: disable=C0301
+# catching too general exception: pylint: disable=W0703
+# too many instance attributes: pylint: disable=R0902
+# parameters differ from overriden: pylint: disable=W0221
+
+import sys
+import os
+import re
+import time
+import math
+import struct
+import hashlib
+import marshal
+import queue
+import sqlite3
+import syslog
+import argparse
+import functools
+import threading
+import configparser
+import urllib.parse
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from socket import AF_INET6
+
+import psycopg2
+import psycopg2.pool
+import psycopg2.extensions
+
+import Milter
+from Milter.utils import parse_addr
+
+# Structured logging to the systemd journal, when the python3-systemd package is installed
+try:
+    from systemd import journal
+except ImportError:
+    journal = None
+
+# Maximum number of log messages waiting to be written
+LOG_QUEUE_SIZE = 1000
+
+
+class LogPipeline(object):
+    """Non-blocking log pipeline, writing to the systemd journal, or to syslog otherwise.
+    The milter callbacks never wait for the log: when the queue is full, the messages
+    are dropped and counted. A background thread writes the messages by batches."""
+
+    def __init__(self, maxSize, batchSize=100):
+        self.queue = queue.Queue(maxsize=maxSize)
+        self.batchSize = batchSize
+        self.identifier = None
+        self.thread = None
+        self.dropped = 0
+        self.reported = 0
+        self.lock = threading.Lock()
+
+    def put(self, message, priority=syslog.LOG_INFO, **fields):
+        """Queue a message, with optional structured fields, or drop it when the queue is full"""
+        try:
+            self.queue.put_nowait((priority, message, fields))
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def start(self, identifier):
+        """Start writing the messages in the background"""
+        self.identifier = identifier
+        syslog.openlog(identifier, syslog.LOG_PID, syslog.LOG_MAIL)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Write the remaining messages, and stop the background thread"""
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        """Write the queued messages by batches, until stopped"""
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < self.batchSize:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for entry in batch:
+                if entry is None:
+                    running = False
+                else:
+                    self.write(*entry)
+
+            # Report the messages dropped since the last batch
+            with self.lock:
+                dropped = self.dropped - self.reported
+                self.reported = self.dropped
+            if dropped:
+                self.write(syslog.LOG_WARNING, "Dropped {} log messages".format(dropped), {'dropped': dropped})
+
+    def write(self, priority, message, fields):
+        """Write one message, with its fields"""
+        if journal:
+            journalFields = {key.upper(): str(value) for key, value in fields.items()}
+            journal.send(message, PRIORITY=priority, SYSLOG_IDENTIFIER=self.identifier, **journalFields)
+        else:
+            details = ' '.join('{}={}'.format(key, value) for key, value in sorted(fields.items()))
+            syslog.syslog(priority, '{} {}'.format(message, details) if details else message)
+
+
+GlobalLog = LogPipeline(LOG_QUEUE_SIZE)
+
+
+class Metrics(object):
+    """Counters, duration histograms and gauges, exported in the Prometheus text format.
+    The metrics are written periodically in a status file, that can be read by the
+    node exporter textfile collector, or simply displayed."""
+
+    # Upper bounds of the duration histograms buckets, in seconds
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        """Increment a counter"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, duration, **labels):
+        """Add a duration to a histogram"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * len(self.BUCKETS), 'sum': 0.0, 'count': 0}
+            for position, bound in enumerate(self.BUCKETS):
+                if duration <= bound:
+                    histogram['buckets'][position] += 1
+            histogram['sum'] += duration
+            histogram['count'] += 1
+
+    def drain(self):
+        """Return the counters and histograms, and start them again from zero,
+        to merge them in the metrics of another process"""
+        with self.lock:
+            counters, histograms = self.counters, self.histograms
+            self.counters, self.histograms = {}, {}
+        return counters, histograms
+
+    def merge(self, state):
+        """Add the counters and histograms drained in another process"""
+        counters, histograms = state
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, histogram in histograms.items():
+                current = self.histograms.setdefault(key, {'buckets': [0] * len(self.BUCKETS), 'sum': 0.0, 'count': 0})
+                current['buckets'] = [first + second for first, second in zip(current['buckets'], histogram['buckets'])]
+                current['sum'] += histogram['sum']
+                current['count'] += histogram['count']
+
+    def gauge(self, name, function, **labels):
+        """Register a gauge, its value is read from the function when exporting"""
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = function
+
+    @staticmethod
+    def formatLabels(labels, *extra):
+        """Format the labels of a sample, e.g. {backend="sogo",le="0.1"}"""
+        allLabels = list(labels) + list(extra)
+        if not allLabels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(key, value) for key, value in allLabels) + '}'
+
+    def export(self):
+        """Return all the metrics, in the Prometheus text format"""
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, dict(value, buckets=list(value['buckets'])))
+                                for key, value in self.histograms.items())
+            gauges = sorted(self.gauges.items())
+
+        for metricType, samples in (('counter', counters), ('gauge', gauges)):
+            declared = set()
+            for (name, labels), value in samples:
+                if name not in declared:
+                    lines.append('# TYPE {} {}'.format(name, metricType))
+                    declared.add(name)
+                lines.append('{}{} {}'.format(name, self.formatLabels(labels), value() if callable(value) else value))
+
+        declared = set()
+        for (name, labels), histogram in histograms:
+            if name not in declared:
+                lines.append('# TYPE {} histogram'.format(name))
+                declared.add(name)
+            for bound, count in zip(self.BUCKETS, histogram['buckets']):
+                lines.append('{}_bucket{} {}'.format(name, self.formatLabels(labels, ('le', bound)), count))
+            lines.append('{}_bucket{} {}'.format(name, self.formatLabels(labels, ('le', '+Inf')), histogram['count']))
+            lines.append('{}_sum{} {}'.format(name, self.formatLabels(labels), histogram['sum']))
+            lines.append('{}_count{} {}'.format(name, self.formatLabels(labels), histogram['count']))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Write the metrics in the status file, replaced in one step"""
+        temporaryPath = path + '.tmp'
+        with open(temporaryPath, 'w') as statusFile:
+            statusFile.write(self.export())
+        os.replace(temporaryPath, path)
+
+
+GlobalMetrics = Metrics()
+
+
+def timed(callback):
+    """Measure the duration of a milter callback. Keep the name, used for the protocol negotiation."""
+    @functools.wraps(callback)
+    def wrapper(self, *args):
+        startTime = time.time()
+        try:
+            return callback(self, *args)
+        finally:
+            GlobalMetrics.observe('milter_callback_seconds', time.time() - startTime, callback=callback.__name__)
+    return wrapper
+
+
+# Statements prepared on each database connection, before deallocating all of them
+MAX_PREPARED_STATEMENTS = 1000
+
+# Seconds without being used, before checking a connection with a query when taking it from the pool
+CONNECTION_CHECK_IDLE = 10
+
+
+class PreparedConnection(psycopg2.extensions.connection):
+    """Database connection preparing each statement on the server with its first use,
+    so the statements are parsed and planned once per connection, not once per message."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.lastUsed = time.time()
+
+        # Read only lookups, do not keep transactions opened while idle
+        self.autocommit = True
+
+    def execute(self, name, query, params=()):
+        """Execute a prepared statement, using $1, $2... placeholders, and return the cursor"""
+        cursor = self.cursor()
+        if name not in self.prepared:
+            # The statements for unknown sets of tables accumulate, start again when too many
+            if len(self.prepared) >= MAX_PREPARED_STATEMENTS:
+                cursor.execute("deallocate all")
+                self.prepared.clear()
+
+            cursor.execute("prepare {} as {}".format(name, query))
+            self.prepared.add(name)
+
+        if params:
+            cursor.execute("execute {} ({})".format(name, ', '.join(['%s'] * len(params))), params)
+        else:
+            cursor.execute("execute {}".format(name))
+        return cursor
+
+
+class ConnectionPool(object):
+    """Process-wide pool of database connections, shared by all the milter instances.
+    The number of connections is bounded, and the callers wait for a free connection."""
+
+    def __init__(self, connectUrl, maxConnections, connectTimeout, statementTimeout):
+        # The queries taking too long are cancelled by the server
+        self.pool = psycopg2.pool.ThreadedConnectionPool(0, maxConnections, connectUrl,
+                                                         connection_factory=PreparedConnection,
+                                                         connect_timeout=connectTimeout,
+                                                         options='-c statement_timeout={}'.format(
+                                                             int(statementTimeout * 1000)))
+        self.available = threading.BoundedSemaphore(maxConnections)
+        self.maxConnections = maxConnections
+        self.connectTimeout = connectTimeout
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        """Return an opened connection, reusing an idle one when possible"""
+        if not self.available.acquire(timeout=self.connectTimeout):
+            raise IOError("No database connection available after {}s".format(self.connectTimeout))
+        try:
+            dbConnection = self.pool.getconn()
+
+            # Discard the connections closed by the server since the last use,
+            # e.g. after a restart or an idle timeout
+            while not self.isAlive(dbConnection):
+                self.pool.putconn(dbConnection, close=True)
+                dbConnection = self.pool.getconn()
+
+            with self.lock:
+                self.used += 1
+            return dbConnection
+
+        except Exception:
+            self.available.release()
+            raise
+
+    @staticmethod
+    def isAlive(dbConnection):
+        """Check if a connection can be used. A connection closed by the server is only
+        known as closed after a query, so the connections idle for a while are checked first."""
+        if dbConnection.closed:
+            return False
+        if time.time() - dbConnection.lastUsed < CONNECTION_CHECK_IDLE:
+            return True
+
+        try:
+            cursor = dbConnection.cursor()
+            cursor.execute("select 1")
+            cursor.close()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def put(self, dbConnection):
+        """Give back a connection to the pool, and close it if it is broken"""
+        dbConnection.lastUsed = time.time()
+        try:
+            self.pool.putconn(dbConnection, close=bool(dbConnection.closed))
+        finally:
+            with self.lock:
+                self.used -= 1
+            self.available.release()
+
+
+class CircuitBreaker(object):
+    """Skip the lookups of a backend after too many consecutive failed or slow lookups.
+    Once the cool-down period is over, one lookup is let through to probe the backend,
+    and the lookups are skipped again for another period if it fails."""
+
+    def __init__(self, maxFailures, coolDown):
+        self.maxFailures = maxFailures
+        self.coolDown = coolDown
+        self.failures = 0
+        self.openUntil = 0
+        self.lock = threading.Lock()
+
+    def isOpen(self):
+        """Check if the lookups are currently skipped"""
+        return self.failures >= self.maxFailures
+
+    def allow(self):
+        """Check if a lookup can be made"""
+        with self.lock:
+            if self.failures < self.maxFailures:
+                return True
+
+            # Let only one lookup probe the backend per cool-down period
+            now = time.time()
+            if now < self.openUntil:
+                return False
+            self.openUntil = now + self.coolDown
+            return True
+
+    def success(self):
+        """Record a lookup made in time"""
+        with self.lock:
+            self.failures = 0
+
+    def failure(self):
+        """Record a failed or slow lookup, and skip the next ones if too many"""
+        with self.lock:
+            self.failures += 1
+            if self.failures == self.maxFailures:
+                self.openUntil = time.time() + self.coolDown
+
+
+# Pseudo table name of the version of the address books list, checked with the tables versions
+ADDRESS_BOOKS_VERSION = 'sogo_folder_info'
+
+
+class AddressBookCache(object):
+    """Bounded LRU cache with a time to live, shared by all the milter instances.
+    The sender lookups are stored with the versions of the address book tables
+    they have been computed from, and are ignored once one of them has changed.
+    The address books of the users are stored with the version of the address books list."""
+
+    def __init__(self, maxSize, ttl, checkInterval):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.checkInterval = checkInterval
+        self.entries = OrderedDict()
+        self.versions = {}
+        self.lastCheck = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value stored for this key, or None if missing or expired"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[1] < time.time():
+                return None
+
+            # Put the entry back, as the most recently used
+            self.entries[key] = entry
+            return entry[0]
+
+    def set(self, key, value):
+        """Store a value, and remove the least recently used entries if needed"""
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time() + self.ttl)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+    def snapshot(self):
+        """Return the entries and the table versions, to restore them after a restart"""
+        with self.lock:
+            return {'entries': [(key, entry[0], entry[1]) for key, entry in self.entries.items()],
+                    'versions': dict(self.versions)}
+
+    def restore(self, state):
+        """Restore the entries not expired and the table versions; the versions are checked with the first lookup"""
+        now = time.time()
+        with self.lock:
+            for key, value, expiry in state['entries']:
+                if expiry > now:
+                    self.entries[key] = (value, expiry)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+            self.versions.update(state['versions'])
+            self.lastCheck = 0
+
+    @staticmethod
+    def versionQuery(table):
+        """Query returning the version of a table: the number of contacts, the last modification,
+        and the sum of the contacts versions, increased by SOGo with each change, as the modifications
+        are only dated to the second. Or the number and last identifier of the address books."""
+        if table == ADDRESS_BOOKS_VERSION:
+            return ("select '{0}', count(*) || ':' || coalesce(max(c_folder_id), 0) from {0}"
+                    " where c_folder_type = 'Contact'".format(table))
+        return ("select '{0}', count(*) || ':' || coalesce(max(c_lastmodified), 0) || ':'"
+                " || coalesce(sum(c_version), 0) from {0}".format(table))
+
+    @staticmethod
+    def versionCount(version):
+        """Return the number of contacts of a table version"""
+        return int(version.split(':')[0])
+
+    def tableVersions(self, tables, dbConnection):
+        """Return the versions of the address book tables, or of the address books list.
+        The database is queried at most once per check interval, or when a table is unknown."""
+        with self.lock:
+            now = time.time()
+            unknown = [table for table in tables if table not in self.versions]
+            expired = now - self.lastCheck >= self.checkInterval
+            if expired:
+                self.lastCheck = now
+                tablesToCheck = set(self.versions.keys()) | set(tables)
+            else:
+                tablesToCheck = set(unknown)
+
+        if tablesToCheck:
+            # One query for all the tables, instead of one per table,
+            # prepared once for each set of tables
+            tablesToCheck = sorted(tablesToCheck)
+            versionQuery = " union all ".join(self.versionQuery(table) for table in tablesToCheck)
+            statementName = 'versions_{}'.format(hashlib.md5(','.join(tablesToCheck).encode()).hexdigest())
+            cursor = dbConnection.execute(statementName, versionQuery)
+            rows = cursor.fetchall()
+            cursor.close()
+
+            with self.lock:
+                for row in rows:
+                    self.versions[row[0]] = row[1]
+
+        with self.lock:
+            return tuple(self.versions.get(table) for table in tables)
+
+
+# Email properties in a vCard, with or without group, e.g. "item1.EMAIL;TYPE=work:john@example.com"
+VCARD_EMAIL_REGEX = re.compile(r'^(?:[\w-]+\.)?EMAIL[^:\r\n]*:(.*)$', re.IGNORECASE | re.MULTILINE)
+
+
+def emailHash(address):
+    """Return the signature of a normalised email address (sha256)"""
+    return hashlib.sha256(address.strip().lower().encode('utf-8')).digest()
+
+
+class AddressBookIndex(object):
+    """In memory index of the email addresses stored in the SOGo address books.
+    Only the address signatures are kept, per table and per contact, and each table
+    is updated incrementally from c_lastmodified when its version changes.
+    The database account is read-only, so the index cannot be stored in a side table.
+    Each table index is updated in place, under the lock of the table."""
+
+    def __init__(self):
+        self.tables = {}
+        self.tableLocks = {}
+        self.lock = threading.Lock()
+
+    def contains(self, tableName, version, addressHash, dbConnection):
+        """Check if the address is in the table, updating the table index if needed.
+        Only the lookups in the same table wait for the update."""
+        with self.lock:
+            tableLock = self.tableLocks.setdefault(tableName, threading.Lock())
+
+        with tableLock:
+            # The index may have been updated by another lookup in the meantime
+            with self.lock:
+                index = self.tables.get(tableName)
+            if index is None or index['version'] != version:
+                index = self.update(tableName, index, version, dbConnection)
+            return addressHash in index['hashes']
+
+    def update(self, tableName, index, version, dbConnection):
+        """Load the contacts modified since the last update in the index, or the full table
+        when it is not loaded yet. Called with the lock of the table."""
+        if index is None:
+            index = self.load(tableName, dbConnection)
+        else:
+            self.updateModified(tableName, index, dbConnection)
+
+        # Contacts have been removed from the table, reload it completely
+        if version is not None and len(index['contacts']) != AddressBookCache.versionCount(version):
+            index = self.load(tableName, dbConnection)
+
+        index['version'] = version
+        with self.lock:
+            self.tables[tableName] = index
+        return index
+
+    def load(self, tableName, dbConnection):
+        """Load the full table in a new index, without the statement timeout of the lookups"""
+        index = {'contacts': {}, 'hashes': {}, 'lastModified': -1, 'version': None}
+        PostgresBackend.unlimitedStatements(dbConnection)
+        try:
+            self.updateModified(tableName, index, dbConnection)
+        finally:
+            PostgresBackend.limitedStatements(dbConnection)
+        return index
+
+    def updateModified(self, tableName, index, dbConnection):
+        """Update the index in place with the contacts modified since its last modification.
+        The last modification is only moved once all the contacts are read, so a failed
+        update is done again with the next lookup."""
+        modifiedQuery = ("select c_name, c_content, c_deleted, c_lastmodified from {}"
+                         " where c_lastmodified >= $1".format(tableName))
+        cursor = dbConnection.execute('modified_{}'.format(tableName), modifiedQuery, (index['lastModified'], ))
+
+        lastModified = index['lastModified']
+        try:
+            for row in cursor:
+                self.updateContact(index, row[0], None if row[2] else row[1])
+                lastModified = max(lastModified, row[3])
+        finally:
+            cursor.close()
+
+        index['lastModified'] = lastModified
+
+    def snapshot(self):
+        """Return the table indexes, to restore them after a restart"""
+        with self.lock:
+            tables = [(tableName, self.tableLocks.setdefault(tableName, threading.Lock()))
+                      for tableName in self.tables]
+
+        state = {}
+        for tableName, tableLock in tables:
+            with tableLock:
+                with self.lock:
+                    index = self.tables[tableName]
+                state[tableName] = {'contacts': dict(index['contacts']), 'hashes': dict(index['hashes']),
+                                    'lastModified': index['lastModified'], 'version': index['version']}
+        return state
+
+    def restore(self, state):
+        """Restore the table indexes, updated incrementally with their next version"""
+        with self.lock:
+            self.tables.update(state)
+
+    @staticmethod
+    def updateContact(index, contactName, content):
+        """Replace the address signatures of a contact, counting the contacts per signature"""
+        hashes = index['hashes']
+        for oldHash in index['contacts'].get(contactName, ()):
+            hashes[oldHash] -= 1
+            if hashes[oldHash] == 0:
+                del hashes[oldHash]
+
+        newHashes = frozenset()
+        if content:
+            newHashes = frozenset(emailHash(address) for address in VCARD_EMAIL_REGEX.findall(content)
+                                  if address.strip())
+
+        for newHash in newHashes:
+            hashes[newHash] = hashes.get(newHash, 0) + 1
+
+        index['contacts'][contactName] = newHashes
+
+
+class KnownAddressesFilter(object):
+    """Bloom filter of all the email addresses stored in the address books, rebuilt periodically.
+    When an address is not in the filter, it is definitely not in any address book,
+    and the database lookup can be skipped. Until the first build, every address may be known."""
+
+    def __init__(self, falsePositiveRate):
+        self.falsePositiveRate = falsePositiveRate
+        self.state = None
+
+    def build(self, addressHashes):
+        """Build a new filter from the address signatures, and replace the current one"""
+        count = max(len(addressHashes), 1)
+        size = int(math.ceil(-count * math.log(self.falsePositiveRate) / (math.log(2) ** 2)))
+        nbHashes = max(int(round(size * math.log(2) / count)), 1)
+        bits = bytearray((size + 7) // 8)
+
+        for addressHash in addressHashes:
+            for position in self.positions(addressHash, size, nbHashes):
+                bits[position >> 3] |= 1 << (position & 7)
+
+        # Replaced in one step, the milter instances read it without locking
+        self.state = (bits, size, nbHashes, len(addressHashes))
+
+    def mayContain(self, addressHash):
+        """Return False only when the address is definitely not in any address book"""
+        state = self.state
+        if state is None:
+            return True
+
+        bits, size, nbHashes = state[0], state[1], state[2]
+        for position in self.positions(addressHash, size, nbHashes):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def statistics(self):
+        """Return the number of addresses, the size in bytes and the estimated false positive rate"""
+        bits, size, nbHashes, count = self.state
+        rate = (1 - math.exp(-float(nbHashes) * count / size)) ** nbHashes
+        return count, len(bits), rate
+
+    @staticmethod
+    def positions(addressHash, size, nbHashes):
+        """Bit positions of an address signature, using double hashing"""
+        first, second = struct.unpack('<QQ', addressHash[:16])
+        return [(first + i * second) % size for i in range(nbHashes)]
+
+
+class AddressBookBackend(object):
+    """Base class of the address book backends.
+    A backend searches the sender address in the recipients address books, and lists
+    all the addresses it knows, to build its known addresses filter."""
+
+    # Name of the backend, in the configuration file, and in the address book sources
+    name = None
+    label = None
+
+    def __init__(self, config, debug):
+        self.debug = debug
+        self.filter = KnownAddressesFilter(config.getfloat('bloom', 'false_positive_rate'))
+        self.lookupTimeout = config.getfloat('timeouts', 'lookup')
+        self.breaker = CircuitBreaker(config.getint('breaker', 'failures'), config.getint('breaker', 'cooldown'))
+        GlobalMetrics.gauge('milter_breaker_open', lambda: int(self.breaker.isOpen()), backend=self.name)
+
+    def search(self, fromAddress, uids, memo, searchFunction=None):
+        """Return the address book sources of the users containing the sender address.
+        The memo is shared by all the lookups of the same message. The search itself
+        can be made by another function, e.g. in a lookup process."""
+        # The backend is failing, do not wait for it
+        if not self.breaker.allow():
+            GlobalMetrics.increment('milter_breaker_total', backend=self.name, result='skipped')
+            return []
+
+        startTime = time.time()
+        try:
+            sources = (searchFunction or self.searchAddress)(fromAddress, uids, memo)
+
+        # Make sure to not prevent the message to pass if something happen,
+        # but log the error
+        except Exception as error:
+            self.breaker.failure()
+            GlobalMetrics.increment('milter_errors_total', backend=self.name, operation='search')
+            GlobalLog.put("Error when searching in {} address database: {}".format(self.name, error),
+                          syslog.LOG_ERR, backend=self.name)
+            return []
+
+        finally:
+            GlobalMetrics.observe('milter_lookup_seconds', time.time() - startTime, backend=self.name)
+
+        # A lookup too slow for the message counts as a failure
+        if time.time() - startTime > self.lookupTimeout:
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+        return sources
+
+    def searchAddress(self, fromAddress, uids, memo):
+        """Search the sender address in the users address books, implemented by each backend"""
+        raise NotImplementedError()
+
+    def memoized(self, memo, key, function, *args):
+        """Call the function only once per message and key; the lookups running at
+        the same time for the other recipients wait for its result.
+        A failed call is forgotten, to be made again by the next lookup."""
+        future = Future()
+        current = memo.setdefault(key, future)
+        if current is future:
+            GlobalMetrics.increment('milter_table_searches_total', backend=self.name)
+            try:
+                future.set_result(function(*args))
+            except Exception as error:
+                memo.pop(key, None)
+                future.set_exception(error)
+        return current.result()
+
+    def loadKnownAddresses(self):
+        """Return the signatures of all the email addresses known, implemented by each backend"""
+        raise NotImplementedError()
+
+    def mayContain(self, addressHash):
+        """Return False only when the address is definitely not in this backend,
+        or when the lookups are skipped because the backend is failing"""
+        if self.breaker.isOpen() and time.time() < self.breaker.openUntil:
+            GlobalMetrics.increment('milter_breaker_total', backend=self.name, result='skipped')
+            return False
+
+        known = self.filter.mayContain(addressHash)
+        GlobalMetrics.increment('milter_filter_total', backend=self.name, result='searched' if known else 'skipped')
+        return known
+
+    def snapshot(self):
+        """Return the state to restore after a restart, made of basic types only"""
+        return {'filter': self.filter.state}
+
+    def restore(self, state):
+        """Restore the state saved before a restart, until the filter is rebuilt"""
+        if state['filter'] is not None and self.filter.state is None:
+            self.filter.state = tuple(state['filter'])
+
+    def rebuildFilter(self):
+        """Rebuild the known addresses filter, and log its statistics"""
+        startTime = time.time()
+        self.filter.build(self.loadKnownAddresses())
+
+        count, size, rate = self.filter.statistics()
+        duration = time.time() - startTime
+        GlobalMetrics.observe('milter_filter_rebuild_seconds', duration, backend=self.name)
+        GlobalLog.put("Rebuilt the {} known addresses filter: {} addresses, {} bytes, "
+                      "{:.4%} false positive rate, in {:.3f}s".format(self.name, count, size, rate, duration),
+                      backend=self.name, addresses=count, size=size, rate=rate, duration=duration)
+
+
+class PostgresBackend(AddressBookBackend):
+    """Base class of the backends using a PostgreSQL database, with a connection pool.
+    The connection parameters are read from the section named like the backend."""
+
+    def __init__(self, config, debug):
+        super().__init__(config, debug)
+        connectUrl = "postgresql://{}:{}@127.0.0.1:5432/{}".format(config.get(self.name, 'user'),
+                                                                   config.get(self.name, 'password'),
+                                                                   config.get(self.name, 'dbName'))
+        self.pool = ConnectionPool(connectUrl, config.getint(self.name, 'max_connections'),
+                                   config.getint('timeouts', 'connect'), config.getfloat('timeouts', 'statement'))
+        GlobalMetrics.gauge('milter_pool_connections_used', lambda: self.pool.used, backend=self.name)
+        GlobalMetrics.gauge('milter_pool_connections_max', lambda: self.pool.maxConnections, backend=self.name)
+
+    def searchAddress(self, fromAddress, uids, memo):
+        # Use a connection from the pool for the time of the search only,
+        # and search again once with another connection if the server has closed it
+        for attempt in range(2):
+            dbConnection = self.pool.get()
+            try:
+                return self.searchInDatabase(fromAddress, uids, memo, dbConnection)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                if attempt or not dbConnection.closed:
+                    raise
+                GlobalMetrics.increment('milter_pool_reconnections_total', backend=self.name)
+            finally:
+                self.pool.put(dbConnection)
+
+    def loadKnownAddresses(self):
+        dbConnection = self.pool.get()
+        try:
+            self.unlimitedStatements(dbConnection)
+            return self.loadFromDatabase(dbConnection)
+        finally:
+            self.limitedStatements(dbConnection)
+            self.pool.put(dbConnection)
+
+    @staticmethod
+    def unlimitedStatements(dbConnection):
+        """Disable the statement timeout of a connection, for the bulk queries"""
+        cursor = dbConnection.cursor()
+        cursor.execute("set statement_timeout = 0")
+        cursor.close()
+
+    @staticmethod
+    def limitedStatements(dbConnection):
+        """Restore the statement timeout of a connection, set when connecting"""
+        if not dbConnection.closed:
+            cursor = dbConnection.cursor()
+            cursor.execute("reset statement_timeout")
+            cursor.close()
+
+    def searchInDatabase(self, fromAddress, uids, memo, dbConnection):
+        """Search the sender address with a database connection, implemented by each backend"""
+        raise NotImplementedError()
+
+    def loadFromDatabase(self, dbConnection):
+        """List the known addresses with a database connection, implemented by each backend"""
+        raise NotImplementedError()
+
+    def exportContacts(self, state):
+        """Yield the contacts modified since the last synchronisation, as (contact, uid, abooks, hashes)
+        tuples, where abooks and hashes are empty for deleted contacts. The state maps the tables
+        to their last modification, and is updated with the contacts exported."""
+        dbConnection = self.pool.get()
+        try:
+            self.unlimitedStatements(dbConnection)
+            yield from self.exportFromDatabase(state, dbConnection)
+        finally:
+            self.limitedStatements(dbConnection)
+            self.pool.put(dbConnection)
+
+    def exportFromDatabase(self, state, dbConnection):
+        """Export the contacts with a database connection, implemented by each backend"""
+        raise NotImplementedError()
+
+
+class SOGoBackend(PostgresBackend):
+    """Search in the SOGo address books, using the lookups cache and the in-memory address index"""
+
+    name = 'sogo'
+    label = 'SOGo'
+
+    def __init__(self, config, debug):
+        super().__init__(config, debug)
+        self.index = AddressBookIndex()
+        self.cache = AddressBookCache(config.getint('cache', 'size'),
+                                      config.getint('cache', 'ttl'),
+                                      config.getint('cache', 'check_interval'))
+
+    def snapshot(self):
+        state = super().snapshot()
+        state['cache'] = self.cache.snapshot()
+        state['index'] = self.index.snapshot()
+        return state
+
+    def restore(self, state):
+        super().restore(state)
+        self.cache.restore(state['cache'])
+        self.index.restore(state['index'])
+
+    def getAddressBooks(self, uid, dbConnection):
+        """Return the address books of a user, as (name, table) tuples"""
+
+        # Use the previous result, unless an address book has been created or deleted since
+        abooksVersion = self.cache.tableVersions([ADDRESS_BOOKS_VERSION], dbConnection)[0]
+        cached = self.cache.get(('abooks', uid))
+        if cached is not None and cached[1] == abooksVersion:
+            return cached[0]
+
+        abQuery = ("select c_foldername, regexp_replace(c_location, '.*/sogo', 'sogo')"
+                   " from sogo_folder_info where"
+                   " c_folder_type='Contact' and c_location like ('%sogo' || $1::text || '%')")
+
+        tablesCursor = dbConnection.execute('sogo_abooks', abQuery, (uid, ))
+
+        tables = tablesCursor.fetchall()
+
+        # End to search in this address book
+        tablesCursor.close()
+
+        self.cache.set(('abooks', uid), (tables, abooksVersion))
+        return tables
+
+    def searchInDatabase(self, fromAddress, uids, memo, dbConnection):
+        sources = []
+        senderHash = emailHash(fromAddress)
+
+        for uid in uids:
+            # First, get all the address books from this user
+            tables = self.getAddressBooks(uid, dbConnection)
+
+            # Use the previous result, unless one of the address books has been modified since
+            # The sender is stored as its signature, the cache being saved in the snapshot
+            versions = self.cache.tableVersions([tableInfo[1] for tableInfo in tables], dbConnection)
+            cached = self.cache.get(('sender', uid, senderHash))
+            if cached is not None and cached[1] == versions:
+                GlobalMetrics.increment('milter_cache_total', backend=self.name, result='hit')
+                if self.debug:
+                    GlobalLog.put("Found address {} for user {} in cache".format(fromAddress, uid), syslog.LOG_DEBUG)
+                sources.extend(cached[0])
+                continue
+
+            GlobalMetrics.increment('milter_cache_total', backend=self.name, result='miss')
+            userSources = []
+
+            # For each table, check if the address is in the table index
+            for tableInfo, version in zip(tables, versions):
+                abName = tableInfo[0]
+                tableName = tableInfo[1]
+                if self.debug:
+                    GlobalLog.put("Searching in table {} ({})".format(tableName, abName), syslog.LOG_DEBUG)
+
+                # Store the address book sources when found
+                # A table shared by several recipients is only searched once per message
+                if self.memoized(memo, (tableName, senderHash), self.index.contains,
+                                 tableName, version, senderHash, dbConnection):
+                    userSources.append('{}:{}'.format(self.label, abName))
+
+            self.cache.set(('sender', uid, senderHash), (userSources, versions))
+            sources.extend(userSources)
+
+            if self.debug:
+                GlobalLog.put("Searched address {} for user {}: {} result(s)".format(
+                    fromAddress, uid, len(userSources)), syslog.LOG_DEBUG)
+
+        return sources
+
+    def loadFromDatabase(self, dbConnection):
+        tablesCursor = dbConnection.cursor()
+        tablesCursor.execute("select regexp_replace(c_location, '.*/sogo', 'sogo')"
+                             " from sogo_folder_info where c_folder_type='Contact';")
+        tables = [tableInfo[0] for tableInfo in tablesCursor.fetchall()]
+        tablesCursor.close()
+
+        addressHashes = set()
+        for tableName in tables:
+            cursor = dbConnection.cursor()
+            cursor.execute("select c_content from {} where coalesce(c_deleted, 0) = 0;".format(tableName))
+            for row in cursor:
+                addressHashes.update(emailHash(address) for address in VCARD_EMAIL_REGEX.findall(row[0] or '')
+                                     if address.strip())
+            cursor.close()
+
+        return addressHashes
+
+
+    def exportFromDatabase(self, state, dbConnection):
+        tablesCursor = dbConnection.cursor()
+        tablesCursor.execute("select c_path2, c_foldername, regexp_replace(c_location, '.*/sogo', 'sogo')"
+                             " from sogo_folder_info where c_folder_type='Contact';")
+        tables = tablesCursor.fetchall()
+        tablesCursor.close()
+
+        # Forget the address books deleted since the last synchronisation
+        for tableName in set(state) - set(tableInfo[2] for tableInfo in tables):
+            del state[tableName]
+
+        for uid, abName, tableName in tables:
+            cursor = dbConnection.cursor()
+            cursor.execute("select c_name, c_content, c_deleted, c_lastmodified from {}"
+                           " where c_lastmodified >= %s;".format(tableName), (state.get(tableName, 0), ))
+            for contactName, content, deleted, lastModified in cursor:
+                hashes = set()
+                if not deleted:
+                    hashes = set(emailHash(address).hex() for address in VCARD_EMAIL_REGEX.findall(content or '')
+                                 if address.strip())
+                state[tableName] = max(state.get(tableName, 0), lastModified)
+                yield '{}/{}'.format(tableName, contactName), uid, [abName] if hashes else [], hashes
+            cursor.close()
+
+            # Keep the empty address books, to detect their deletion
+            state.setdefault(tableName, 0)
+
+
+class RoundcubeBackend(PostgresBackend):
+    """Search in the Roundcube address books, with one query for all the recipients"""
+
+    name = 'roundcube'
+    label = 'Roundcube'
+
+    def searchInDatabase(self, fromAddress, uids, memo, dbConnection):
+        sources = []
+
+        # One query for all the recipients, the address books are mapped back to each user
+        abQuery = ("select distinct u.username, cg.name from contacts as c"
+                   " left join contactgroupmembers as cgm"
+                   " on cgm.contact_id = c.contact_id"
+                   " left join contactgroups as cg"
+                   " on cg.contactgroup_id=cgm.contactgroup_id"
+                   " join users as u"
+                   " on u.user_id = c.user_id"
+                   " where u.username = any($1) and"
+                   " c.words like $2::text escape '\\' and"
+                   " c.del = 0")
+
+        GlobalMetrics.increment('milter_table_searches_total', backend=self.name)
+        tablesCursor = dbConnection.execute('roundcube_abooks', abQuery,
+                                            (list(set(uids)), self.wordsPattern(fromAddress)))
+
+        userAbooks = {}
+        for abResult in tablesCursor:
+            userAbooks.setdefault(abResult[0], []).append(abResult[1])
+
+        # End to search in the recipients address books
+        tablesCursor.close()
+
+        for uid in uids:
+            # Store the address book name, or "default" when no name
+            for abName in userAbooks.get(uid, []):
+                if abName:
+                    source = "{}:{}".format(self.label, abName)
+                else:
+                    source = "{}:default".format(self.label)
+
+                # Insert if not already inside.
+                if not source in sources:
+                    sources.append(source)
+
+        if self.debug:
+            GlobalLog.put("Searched address {} for users {}: {} result(s)".format(
+                fromAddress, ','.join(uids), len(sources)), syslog.LOG_DEBUG)
+
+        return sources
+
+    @staticmethod
+    def wordsPattern(address):
+        """Return the pattern matching an address in the contact words, normalised in lower case by
+        Roundcube, with the wildcard characters of the address escaped"""
+        address = address.strip().lower()
+        for character in ('\\', '%', '_'):
+            address = address.replace(character, '\\' + character)
+        return '%' + address + '%'
+
+    def loadFromDatabase(self, dbConnection):
+        cursor = dbConnection.cursor()
+        cursor.execute("select email from contacts where del = 0")
+
+        addressHashes = set()
+        for row in cursor:
+            addressHashes.update(emailHash(address) for address in (row[0] or '').split(',')
+                                 if address.strip())
+        cursor.close()
+
+        return addressHashes
+
+
+    def exportFromDatabase(self, state, dbConnection):
+        # The group memberships do not change the contact modification time,
+        # they are synchronised with the full synchronisations only
+        cursor = dbConnection.cursor()
+        cursor.execute("select c.contact_id, u.username, cg.name, c.email, c.del,"
+                       " extract(epoch from c.changed)::integer from contacts as c"
+                       " left join contactgroupmembers as cgm"
+                       " on cgm.contact_id = c.contact_id"
+                       " left join contactgroups as cg"
+                       " on cg.contactgroup_id=cgm.contactgroup_id and cg.del = 0"
+                       " join users as u"
+                       " on u.user_id = c.user_id"
+                       " where c.changed >= to_timestamp(%s)"
+                       " order by c.contact_id", (state.get('contacts', 0), ))
+
+        contact = None
+        for contactId, uid, abName, addresses, deleted, lastModified in cursor:
+            state['contacts'] = max(state.get('contacts', 0), lastModified)
+
+            # One row per group of the contact
+            if contact is not None and contact[0] != str(contactId):
+                yield contact
+                contact = None
+
+            if contact is None:
+                hashes = set()
+                if not deleted:
+                    hashes = set(emailHash(address).hex() for address in (addresses or '').split(',')
+                                 if address.strip())
+                contact = (str(contactId), uid, [], hashes)
+
+            if contact[3]:
+                contact[2].append(abName or 'default')
+
+        if contact is not None:
+            yield contact
+        cursor.close()
+
+
+# Local database schema: the primary key starts with the lookup columns, and covers the lookups
+SQLITE_SCHEMA = (
+    "create table if not exists addresses (uid varchar, email_hash char(64), source varchar,"
+    " abook varchar, contact varchar, primary key (uid, email_hash, source, abook, contact)) without rowid",
+    "create index if not exists addresses_contact_idx on addresses (source, contact)",
+    "create table if not exists sync_state (source varchar, tablename varchar, lastmodified integer,"
+    " primary key (source, tablename))",
+)
+
+# Size of the local database mapped in memory by each connection
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+
+
+class SQLiteBackend(AddressBookBackend):
+    """Search in a local sqlite database, storing only the email address signatures.
+    The table addresses(uid, email_hash, source, abook, contact) contains the sha256 hexadecimal
+    signature of each normalised (trimmed and lower case) email address, and is filled by
+    the synchronisation from the other backends. Each thread keeps its own read-only connection."""
+
+    name = 'sqlite'
+
+    def __init__(self, config, debug):
+        super().__init__(config, debug)
+        self.path = config.get('sqlite', 'path')
+        self.connectTimeout = config.getint('timeouts', 'connect')
+        self.local = threading.local()
+
+    def connection(self):
+        """Return the read-only connection of the current thread, opened with the first lookup"""
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect('file:{}?mode=ro'.format(urllib.parse.quote(self.path)), uri=True,
+                                 timeout=self.connectTimeout)
+            db.execute("pragma mmap_size={}".format(SQLITE_MMAP_SIZE))
+            self.local.db = db
+        return db
+
+    def searchAddress(self, fromAddress, uids, memo):
+        sources = []
+        query = "select source, abook from addresses where uid=? and email_hash=?"
+
+        # get the from email address signature
+        addressHash = emailHash(fromAddress).hex()
+
+        # Check if the email address is in the user's address book
+        cursor = self.connection().cursor()
+
+        for uid in uids:
+            GlobalMetrics.increment('milter_table_searches_total', backend=self.name)
+            cursor.execute(query, (uid, addressHash))
+
+            # Store the address book sources when found
+            for row in cursor:
+                sources.append('{0}:{1}'.format(row[0], row[1]))
+
+            if self.debug:
+                GlobalLog.put("Searched address hash {} for user {}: {} result(s)".format(
+                    addressHash, uid, len(sources)), syslog.LOG_DEBUG)
+
+        cursor.close()
+        return sources
+
+    def loadKnownAddresses(self):
+        cursor = self.connection().execute("select distinct email_hash from addresses")
+        try:
+            return set(bytes.fromhex(row[0]) for row in cursor)
+        finally:
+            cursor.close()
+
+    def synchronise(self, backend, full):
+        """Copy the address signatures of another backend, modified since the last synchronisation,
+        or all of them when full is set. Return the number of contacts copied."""
+        db = sqlite3.connect(self.path)
+        try:
+            # The lookups are not blocked during the synchronisation
+            db.execute("pragma journal_mode=wal")
+            for statement in SQLITE_SCHEMA:
+                db.execute(statement)
+
+            state = {}
+            if not full:
+                state = dict(db.execute("select tablename, lastmodified from sync_state where source=?",
+                                        (backend.label, )))
+            previousTables = set(state)
+
+            # One transaction, the lookups see all the modifications at once
+            nbContacts = 0
+            with db:
+                if full:
+                    db.execute("delete from addresses where source=?", (backend.label, ))
+
+                for contact, uid, abooks, hashes in backend.exportContacts(state):
+                    db.execute("delete from addresses where source=? and contact=?", (backend.label, contact))
+                    db.executemany("insert or ignore into addresses values (?, ?, ?, ?, ?)",
+                                   ((uid, addressHash, backend.label, abName, contact)
+                                    for addressHash in hashes for abName in abooks))
+                    nbContacts += 1
+
+                # Remove the contacts of the address books deleted
+                for tableName in previousTables - set(state):
+                    db.execute("delete from addresses where source=? and contact like ?",
+                               (backend.label, '{}/%'.format(tableName)))
+
+                db.execute("delete from sync_state where source=?", (backend.label, ))
+                db.executemany("insert into sync_state values (?, ?, ?)",
+                               ((backend.label, tableName, lastModified) for tableName, lastModified in state.items()))
+
+            return nbContacts
+        finally:
+            db.close()
+
+
+# Backends available, by name in the configuration file
+BACKENDS = {backend.name: backend for backend in (SOGoBackend, RoundcubeBackend, SQLiteBackend)}
+
+# Backends of a lookup process, created when the process starts
+ProcessBackends = {}
+
+
+def initLookupProcess(configPath, workers):
+    """Create the backends of a lookup process, with their own database connections.
+    The database connections are divided between the lookup processes."""
+    config = configparser.RawConfigParser()
+    config.read(configPath)
+    debug = config.getboolean('main', 'debug')
+    GlobalLog.start('{}-lookup'.format(config.get('main', 'name')))
+    for backendName in config.get('main', 'backends').split(','):
+        backendName = backendName.strip()
+        if not backendName:
+            continue
+        if config.has_option(backendName, 'max_connections'):
+            config.set(backendName, 'max_connections',
+                       str(max(config.getint(backendName, 'max_connections') // workers, 1)))
+        ProcessBackends[backendName] = BACKENDS[backendName](config, debug)
+
+
+def processSearch(backendName, fromAddress, uids):
+    """Search in a backend of a lookup process. Return the sources found, with the metrics
+    counted since the previous search, to merge them in the milter process metrics."""
+    sources = ProcessBackends[backendName].searchAddress(fromAddress, uids, {})
+    return sources, GlobalMetrics.drain()
+
+
+class LookupExecutor(object):
+    """Run the lookups in a pool of threads, waiting for a pool of processes with the processes model,
+    each process with its own backends. The circuit breakers, the lookup deadlines and the metrics
+    stay in the milter process. The number of lookups pending is bounded, and new messages are
+    refused once it is reached."""
+
+    def __init__(self, model, workers, maxPending, configPath):
+        self.processes = None
+        if model == 'processes':
+            # Started from a clean interpreter, not forked from the threads of the milter
+            self.processes = ProcessPoolExecutor(max_workers=workers,
+                                                 mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=initLookupProcess, initargs=(configPath, workers))
+        elif model != 'threads':
+            raise ValueError("Unknown worker model {}".format(model))
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+        self.maxPending = maxPending
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def saturated(self):
+        """Check if the lookups pending have reached the limit"""
+        return self.pending >= self.maxPending
+
+    def search(self, backend, fromAddress, uids, memo):
+        """Start a lookup, and return its future, or None when saturated"""
+        with self.lock:
+            if self.pending >= self.maxPending:
+                return None
+            self.pending += 1
+
+        try:
+            if self.processes is not None:
+                future = self.executor.submit(backend.search, fromAddress, uids, memo,
+                                              functools.partial(self.processSearch, backend.name))
+            else:
+                future = self.executor.submit(backend.search, fromAddress, uids, memo)
+        except Exception:
+            self.done(None)
+            raise
+
+        future.add_done_callback(self.done)
+        return future
+
+    def processSearch(self, backendName, fromAddress, uids, memo):
+        """Search in a lookup process, and merge the metrics counted by the process.
+        The memo is not shared with the lookup processes, each lookup covers all the
+        recipients of a message."""
+        sources, metrics = self.processes.submit(processSearch, backendName, fromAddress, uids).result()
+        GlobalMetrics.merge(metrics)
+        return sources
+
+    def done(self, future):
+        """Count a lookup finished"""
+        with self.lock:
+            self.pending -= 1
+
+
+class MarkAddressBookMilter(Milter.Base):
+    """Milter to search the sender address in the recipient's address books."""
+
+    # Shared by all the instances, initialised when starting the milter
+    backends = []
+    workers = None
+    debug = False
+    recipientDelimiter = ''
+    lookupTimeout = None
+
+    # A new instance with each new connection.
+    def __init__(self):
+
+        # Integer incremented with each call.
+        self.id = Milter.uniqueID()
+
+    # Should be executed at the end of a message parsing
+    def __exit__(self, exc_type, exc_val, exc_tb):
+
+        if self.debug:
+            self.queueLogMessage("Exit from milter address book")
+
+    # Each connection runs in its own thread and has its own
+    # MarkAddressBookMilter instance.
+    # Python code must be thread safe. This is trivial if only stuff
+    # in MarkAddressBookMilter instances is referenced.
+    @Milter.noreply
+    @timed
+    def connect(self, hostname, family, hostaddr):
+        self.IP = hostaddr[0]
+        self.port = hostaddr[1]
+        if family == AF_INET6:
+            self.flow = hostaddr[2]
+            self.scope = hostaddr[3]
+        else:
+            self.flow = None
+            self.scope = None
+        self.IPname = hostname    # Name from a reverse IP lookup
+        self.H = None
+        self.receiver = self.getsymval('j')
+
+        if self.debug:
+            self.queueLogMessage("connect from {} at {}".format(hostname, hostaddr))
+
+        return Milter.CONTINUE
+
+    @timed
+    def envfrom(self, fromAddress, *extra):
+        self.mailFrom = '@'.join(parse_addr(fromAddress))
+        self.recipients = []
+        self.fromparms = Milter.dictfromlist(extra) # ESMTP parms
+        self.user = self.getsymval('{auth_authen}') # authenticated user
+        self.lookups = []
+
+        # Users to search, and results shared by the lookups of this message
+        self.uids = []
+        self.memo = {}
+        self.lookupsStarted = False
+
+        # Only search in the backends where the sender may be known
+        senderHash = emailHash(self.mailFrom)
+        self.searchBackends = [backend for backend in self.backends if backend.mayContain(senderHash)]
+        if not self.searchBackends and self.debug:
+            self.queueLogMessage("Address {} is not in any address book".format(self.mailFrom))
+
+        # Ask the MTA to retry later rather than queuing lookups without bound
+        if self.searchBackends and self.workers.saturated():
+            GlobalMetrics.increment('milter_backpressure_total', step='envfrom')
+            self.queueLogMessage("Too many lookups pending, message from {} deferred".format(self.mailFrom),
+                                 syslog.LOG_WARNING)
+            return Milter.TEMPFAIL
+
+        return Milter.CONTINUE
+
+    @Milter.noreply
+    @timed
+    def envrcpt(self, to, *extra):
+        rcptinfo = to, Milter.dictfromlist(extra)
+        self.recipients.append(rcptinfo)
+
+        # Search each user only once, whatever the aliases, extensions or duplicate recipients
+        uid = self.recipientUid(to)
+        if uid not in self.uids:
+            self.uids.append(uid)
+
+        return Milter.CONTINUE
+
+    @Milter.noreply
+    @timed
+    def data(self):
+        # All the recipients are known, search while the rest of the message is transferred
+        self.startLookups()
+        return Milter.CONTINUE
+
+    def startLookups(self):
+        """Start one lookup per backend for all the recipients, once per message.
+        The message cannot be deferred here, the lookups are skipped when saturated."""
+        if self.lookupsStarted:
+            return
+        self.lookupsStarted = True
+
+        if not self.uids:
+            return
+
+        for backend in self.searchBackends:
+            lookup = self.workers.search(backend, self.mailFrom, list(self.uids), self.memo)
+            if lookup is None:
+                GlobalMetrics.increment('milter_backpressure_total', step='data')
+            else:
+                self.lookups.append(lookup)
+
+    # The header, eoh and body callbacks are not implemented on purpose: the message
+    # content is not needed, and the MTA is told to not send it during the negotiation.
+
+    # Add the headers at the eom (End of Message) function.
+    # This should work when the recipient is in any of To, CC or BCC headers
+    @timed
+    def eom(self):
+
+        # Start the lookups now if the MTA has not sent the data step
+        self.startLookups()
+
+        # Include all the sources in the same header, joined by coma
+        # The lookups have been started at the data step, only collect the results,
+        # and accept the message without waiting for the lookups still running after the deadline
+        sources = []
+        deadline = time.time() + self.lookupTimeout
+        for lookup in self.lookups:
+            try:
+                for source in lookup.result(timeout=max(deadline - time.time(), 0)):
+                    # Insert if not already inside.
+                    if not source in sources:
+                        sources.append(source)
+            except FutureTimeoutError:
+                GlobalMetrics.increment('milter_errors_total', operation='timeout')
+                self.queueLogMessage("Address books lookup still running after {}s".format(self.lookupTimeout),
+                                     syslog.LOG_WARNING)
+            except Exception as error:
+                GlobalMetrics.increment('milter_errors_total', operation='lookup')
+                self.queueLogMessage("Could not search in the address books: {}".format(error), syslog.LOG_ERR)
+
+        GlobalMetrics.increment('milter_messages_total', tagged='yes' if sources else 'no')
+        if sources:
+            self.addheader("X-AddressBook", ','.join(sources))
+
+        return Milter.ACCEPT
+
+    def close(self):
+        # always called, even when abort is called. Clean up
+        # any external resources here.
+        return Milter.CONTINUE
+
+    def abort(self):
+        # client disconnected prematurely
+        return Milter.CONTINUE
+
+    def recipientUid(self, address):
+        """Return the user name of a recipient address, in lower case and without extension"""
+        uid = parse_addr(address)[0].lower()
+        if self.recipientDelimiter:
+            uid = uid.split(self.recipientDelimiter, 1)[0]
+        return uid
+
+    def queueLogMessage(self, msg, priority=syslog.LOG_DEBUG):
+        """Add a message to the log queue"""
+        GlobalLog.put(msg, priority, milter=self.id)
+
+
+# Background thread rebuilding the known addresses filters
+def filterThread(backends, interval):
+    """Rebuild the known addresses filter of each backend periodically"""
+    while True:
+        for backend in backends:
+            try:
+                backend.rebuildFilter()
+            except Exception as error:
+                GlobalMetrics.increment('milter_errors_total', backend=backend.name, operation='filter')
+                GlobalLog.put("Error when building the {} known addresses filter: {}".format(
+                    backend.name, error), syslog.LOG_ERR, backend=backend.name)
+        time.sleep(interval)
+
+
+# Background thread writing the metrics
+def metricsThread(path, interval):
+    """Write the metrics in the status file periodically"""
+    while True:
+        time.sleep(interval)
+        try:
+            GlobalMetrics.write(path)
+        except Exception as error:
+            GlobalLog.put("Error when writing the metrics in {}: {}".format(path, error), syslog.LOG_ERR)
+
+
+# Version of the snapshot format, the older snapshots are ignored.
+# The snapshot is written with marshal, whose format depends on the Python version,
+# so the snapshots written by another Python version are ignored as well
+SNAPSHOT_VERSION = 3
+
+
+def saveSnapshot(backends, path):
+    """Write the state of the backends in the snapshot file, replaced in one step,
+    and only readable by the milter"""
+    state = {'version': SNAPSHOT_VERSION, 'python': tuple(sys.version_info[:2]),
+             'backends': {backend.name: backend.snapshot() for backend in backends}}
+    temporaryPath = path + '.tmp'
+    with os.fdopen(os.open(temporaryPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as snapshotFile:
+        os.fchmod(snapshotFile.fileno(), 0o600)
+        marshal.dump(state, snapshotFile)
+    os.replace(temporaryPath, path)
+
+
+def loadSnapshot(backends, path):
+    """Restore the state of the backends from the snapshot file, to avoid a cold start"""
+    if not os.path.exists(path):
+        return
+
+    # Start cold rather than not starting
+    try:
+        with open(path, 'rb') as snapshotFile:
+            state = marshal.load(snapshotFile)
+        if state.get('version') != SNAPSHOT_VERSION or state.get('python') != tuple(sys.version_info[:2]):
+            GlobalLog.put("Ignored the snapshot {}, version {}, Python {}".format(
+                path, state.get('version'), state.get('python')), syslog.LOG_WARNING)
+            return
+
+        for backend in backends:
+            if backend.name in state['backends']:
+                backend.restore(state['backends'][backend.name])
+        GlobalLog.put("Restored the snapshot {}".format(path))
+
+    except Exception as error:
+        GlobalLog.put("Error when restoring the snapshot {}: {}".format(path, error), syslog.LOG_ERR)
+
+
+# Background thread saving the state of the backends
+def snapshotThread(backends, path, interval):
+    """Write the snapshot file periodically"""
+    while True:
+        time.sleep(interval)
+        try:
+            saveSnapshot(backends, path)
+        except Exception as error:
+            GlobalLog.put("Error when writing the snapshot {}: {}".format(path, error), syslog.LOG_ERR)
+
+
+def synchronise(config, name, backendName, full):
+    """Copy the address signatures of a backend into the local sqlite database"""
+    GlobalLog.start('{}-sync'.format(name))
+    try:
+        debug = config.getboolean('main', 'debug')
+        backend = BACKENDS[backendName](config, debug)
+        startTime = time.time()
+        nbContacts = SQLiteBackend(config, debug).synchronise(backend, full)
+        GlobalLog.put("Synchronised {} {} contacts in {:.3f}s".format(nbContacts, backend.label, time.time() - startTime),
+                      backend=backendName, contacts=nbContacts)
+
+    except Exception as error:
+        GlobalLog.put("Error when synchronising the {} contacts: {}".format(backendName, error), syslog.LOG_ERR)
+        print("Exception when synchronising the contacts: {}".format(error))
+        sys.exit(1)
+
+    finally:
+        GlobalLog.stop()
+
+
+def main(args):
+    """Main entry point, run the milter and start the background logging daemon"""
+
+    config = configparser.RawConfigParser()
+    config.read(args.config)
+
+    name = config.get('main', 'name')
+    pidFilePath = config.get('main', 'pid_file')
+
+    # Synchronise the local database and exit, without running the milter
+    if args.sync:
+        synchronise(config, name, args.sync, args.full)
+        return
+
+    # Exit if the main thread have been already created
+    if os.path.exists(pidFilePath):
+        print("pid file {} already exists, exiting".format(pidFilePath))
+        sys.exit(-1)
+
+    try:
+        debug = config.getboolean('main', 'debug')
+
+        GlobalLog.start(name)
+        timeout = 600
+
+        # Initialise the backends to search in, in the configuration order
+        backendNames = [backendName.strip() for backendName in config.get('main', 'backends').split(',')]
+        backends = [BACKENDS[backendName](config, debug) for backendName in backendNames if backendName]
+
+        # Start with the state saved before the last stop, then save it periodically
+        snapshotPath = config.get('snapshot', 'path')
+        loadSnapshot(backends, snapshotPath)
+        snThread = threading.Thread(target=snapshotThread,
+                                    args=(backends, snapshotPath, config.getint('snapshot', 'interval')))
+        snThread.daemon = True
+        snThread.start()
+
+        # Build the known addresses filters in the background
+        flThread = threading.Thread(target=filterThread,
+                                    args=(backends, config.getint('bloom', 'rebuild_interval')))
+        flThread.daemon = True
+        flThread.start()
+
+        # Write the metrics in the background
+        GlobalMetrics.gauge('milter_log_dropped_messages', lambda: GlobalLog.dropped)
+        mtThread = threading.Thread(target=metricsThread,
+                                    args=(config.get('metrics', 'path'), config.getint('metrics', 'interval')))
+        mtThread.daemon = True
+        mtThread.start()
+
+        # Register to have the Milter factory create new instances
+        MarkAddressBookMilter.backends = backends
+        MarkAddressBookMilter.workers = LookupExecutor(config.get('main', 'worker_model'),
+                                                       config.getint('main', 'workers'),
+                                                       config.getint('main', 'max_pending'),
+                                                       args.config)
+        GlobalMetrics.gauge('milter_lookups_pending', lambda: MarkAddressBookMilter.workers.pending)
+        MarkAddressBookMilter.debug = debug
+        MarkAddressBookMilter.recipientDelimiter = config.get('main', 'recipient_delimiter')
+        MarkAddressBookMilter.lookupTimeout = config.getfloat('timeouts', 'lookup')
+        Milter.factory = MarkAddressBookMilter
+
+        # For this milter, we only add headers
+        # Headers and body are skipped with P_NOHDRS / P_NOBODY, negotiated by Milter.Base
+        flags = Milter.ADDHDRS
+        Milter.set_flags(flags)
+
+        # Get the parent process ID and remember it
+        pid = os.getpid()
+        with open(pidFilePath, "w") as pidFile:
+            pidFile.write(str(pid))
+
+        GlobalLog.put("Started address book search and tag milter {} (pid={}, backends={}, debug={})".format(
+            name, pid, ','.join(backendNames), debug))
+
+        # Start the background thread
+        Milter.runmilter(name, config.get('main', 'socket'), timeout)
+
+        # Save the state for the next start
+        try:
+            saveSnapshot(backends, snapshotPath)
+        except Exception as error:
+            GlobalLog.put("Error when writing the snapshot {}: {}".format(snapshotPath, error), syslog.LOG_ERR)
+
+        # Log the end of process, and wait until the logging thread terminates
+        GlobalLog.put("Stopped address book search and tag milter {} (pid={})".format(name, pid))
+        GlobalLog.stop()
+
+    except Exception as error:
+        print("Exception when running the milter: {}".format(error))
+
+    # Make sure to remove the pid file even if an error occurs
+    finally:
+        if os.path.exists(pidFilePath):
+            os.remove(pidFilePath)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Address book search and tag milter')
+
+    parser.add_argument(
+        '--config',
+        type=str,
+        help="The milter configuration file",
+        required=True)
+
+    parser.add_argument(
+        '--sync',
+        type=str,
+        choices=['sogo', 'roundcube'],
+        help="Copy the address signatures of this backend into the sqlite database, and exit")
+
+    parser.add_argument(
+        '--full',
+        action='store_true',
+        help="Copy all the address signatures, not only the modified contacts")
+
+    main(parser.parse_args())
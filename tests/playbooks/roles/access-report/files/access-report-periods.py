@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+# Check the connections counted in each report period.
+# For each period, a connections database is created with the schema of the
+# access check, with one connection just before the first day, one on the
+# first day, one just before the end and one at the end of the period. The
+# report built by the access report script must count the second and the
+# third connections only.
+
+# Andre Rodier <andre@rodier.me>
+# Licence: GPL v2
+
+import os
+import sys
+import sqlite3
+import argparse
+import datetime
+import tempfile
+import importlib.util
+
+# Schema created by the access check installation
+SCHEMA = [
+    "create table connections ("
+    " unixtime timestamp DEFAULT CURRENT_TIMESTAMP, ip VARCHAR, countryCode CHAR(2),"
+    " countryName VARCHAR, source VARCHAR, provider VARCHAR DEFAULT NULL,"
+    " mobile BOOLEAN DEFAULT NULL, type CHAR(10) DEFAULT NULL, status CHAR(10),"
+    " score SMALLINT DEFAULT 0, details TEXT DEFAULT '')",
+    "create index unixtime_idx on connections (unixtime)",
+]
+
+# Connections expected in the reports, by source name
+EXPECTED_SOURCES = ['first-day', 'before-end']
+
+parser = argparse.ArgumentParser(description='Access report periods check')
+parser.add_argument('--script', default='/usr/local/bin/access-report.py',
+                    help="The access report script to check")
+args = parser.parse_args()
+
+spec = importlib.util.spec_from_file_location('access_report', args.script)
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+
+
+def periodWindow(period, today):
+    """Return the first day included and the last day excluded of a period, in UTC"""
+    tomorrow = today + datetime.timedelta(days=1)
+    if period == module.Period.lastWeek:
+        return today - datetime.timedelta(days=7), tomorrow
+    if period == module.Period.lastMonth:
+        end = today.replace(day=1)
+        return (end - datetime.timedelta(days=1)).replace(day=1), end
+    if period == module.Period.lastYear:
+        end = today.replace(month=1, day=1)
+        return end.replace(year=end.year - 1), end
+    return None, tomorrow
+
+
+def checkPeriod(period, today):
+    """Build the report of a period from the boundary connections, and return False when it is wrong"""
+    start, end = periodWindow(period, today)
+    oneSecond = datetime.timedelta(seconds=1)
+    startTime = datetime.datetime.combine(start or datetime.date(2000, 1, 1), datetime.time())
+    endTime = datetime.datetime.combine(end, datetime.time())
+
+    connections = [('first-day', startTime), ('before-end', endTime - oneSecond), ('at-end', endTime)]
+    if start is not None:
+        connections.append(('before-start', startTime - oneSecond))
+
+    dbPath = os.path.join(tempfile.mkdtemp(), 'imap-connections.db')
+    conn = sqlite3.connect(dbPath)
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.executemany("insert into connections (unixtime, ip, countryCode, countryName, source, provider, status)"
+                     " values (?, '192.0.2.1', 'FR', 'France', ?, 'ISP', 'OK')",
+                     [(time.strftime("%Y-%m-%d %H:%M:%S"), source) for source, time in connections])
+    conn.commit()
+
+    # Build the report with the script itself, on the test database
+    builder = module.ReportBuilder.__new__(module.ReportBuilder)
+    builder.conn = conn
+    builder.connLogFile = dbPath
+    builder.scope = ()
+    builder.migrate()
+    builder.version = conn.execute("pragma user_version").fetchone()[0]
+    builder.initPeriod(period)
+    builder.updateRollup()
+
+    nbConnections = builder.nbConnections()
+    sources = sorted(line['source'] for line in builder.reports()['sourceReport'])
+
+    success = nbConnections == len(EXPECTED_SOURCES) and sources == sorted(EXPECTED_SOURCES)
+    print("{}: from {} to {} (excluded), {} connection(s): {}{}".format(
+        period, builder.periodStart or 'the beginning', builder.periodEnd, nbConnections,
+        ', '.join(sources), '' if success else '  <-- expected {}'.format(', '.join(EXPECTED_SOURCES))))
+
+    conn.close()
+    return success
+
+
+failed = False
+for period in module.Period:
+    if not checkPeriod(period, datetime.date.today()):
+        failed = True
+
+sys.exit(1 if failed else 0)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# Check the queries of the access reports only read the indexes.
+# A connections database is created with the schema of the access check,
+# migrated by the access report script, and the plan of each report query
+# is checked to use a covering index, or the primary key of the tables
+# listed below, in the database of a user and in the consolidated store.
+
+# Andre Rodier <andre@rodier.me>
+# Licence: GPL v2
+
+import os
+import re
+import sys
+import sqlite3
+import argparse
+import tempfile
+import importlib.util
+
+# Schema created by the access check installation
+SCHEMA = [
+    "create table connections ("
+    " unixtime timestamp DEFAULT CURRENT_TIMESTAMP, ip VARCHAR, countryCode CHAR(2),"
+    " countryName VARCHAR, source VARCHAR, provider VARCHAR DEFAULT NULL,"
+    " mobile BOOLEAN DEFAULT NULL, type CHAR(10) DEFAULT NULL, status CHAR(10),"
+    " score SMALLINT DEFAULT 0, details TEXT DEFAULT '')",
+    "create index unixtime_idx on connections (unixtime)",
+    "create index ip_idx on connections (ip)",
+    "create index country_idx on connections (countryCode)",
+    "create index status_idx on connections (status)",
+]
+
+parser = argparse.ArgumentParser(description='Access report query plans check')
+parser.add_argument('--script', default='/usr/local/bin/access-report.py',
+                    help="The access report script to check")
+args = parser.parse_args()
+
+spec = importlib.util.spec_from_file_location('access_report', args.script)
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+
+dbPath = os.path.join(tempfile.mkdtemp(), 'imap-connections.db')
+conn = sqlite3.connect(dbPath)
+for statement in SCHEMA:
+    conn.execute(statement)
+conn.executemany("insert into connections (unixtime, ip, countryCode, countryName, source, provider, status)"
+                 " values (datetime('now', ?), ?, 'FR', 'France', 'imap', ?, 'OK')",
+                 [('-{} hours'.format(hour), '192.0.2.{}'.format(hour % 10), None if hour % 3 else 'ISP')
+                  for hour in range(100)])
+conn.commit()
+
+# Migrate the database with the script itself
+builder = module.ReportBuilder.__new__(module.ReportBuilder)
+builder.conn = conn
+builder.connLogFile = dbPath
+builder.migrate()
+
+version = conn.execute("pragma user_version").fetchone()[0]
+print("Database migrated to version {}".format(version))
+failed = version != len(module.MIGRATIONS)
+
+# Tables, or their aliases, read with their primary key on purpose. The labels are read by identifier,
+# and the connections log "l" from the last connection aggregated: by rowid in the database of a user,
+# and in the store, where the table is WITHOUT ROWID, in the primary key holding the rows
+PRIMARY_KEY_TABLES = {'countries', 'providers', 'sources', 'statuses', 'l'}
+
+# Search of a table with its primary key, e.g. "SEARCH l USING PRIMARY KEY (uid=? AND id>?)"
+PRIMARY_KEY_SEARCH = re.compile(r'^SEARCH (?:TABLE )?(\w+)(?: AS (\w+))? USING (?:INTEGER )?PRIMARY KEY ')
+
+# The queries reading the connections or the aggregates
+READ_QUERIES = ['nbConnections', 'unresolvedAddresses', 'unresolvedDays',
+                'aggregateDay', 'newConnections', 'firstDay', 'reports']
+
+
+def checkPlans(conn, builder, scope):
+    """Display the plan of each query, and return False when one reads a table"""
+    success = True
+    for name in READ_QUERIES:
+        if name not in builder.QUERIES:
+            continue
+        query = builder.QUERIES[name]
+        params = scope + ('2000-01-01', ) * (query.count('?') - len(scope))
+        plan = conn.execute("explain query plan " + query, params).fetchall()
+        print("{}.{}".format(builder.__name__, name))
+        for row in plan:
+            detail = row[-1]
+            primaryKeySearch = PRIMARY_KEY_SEARCH.match(detail)
+            indexOnly = 'COVERING INDEX' in detail or (primaryKeySearch is not None and (
+                primaryKeySearch.group(2) or primaryKeySearch.group(1)) in PRIMARY_KEY_TABLES)
+            if detail.startswith(('SCAN', 'SEARCH')) and not indexOnly:
+                success = False
+                detail += '  <-- not index only'
+            print('    ' + detail)
+    return success
+
+
+if not checkPlans(conn, module.ReportBuilder, ()):
+    failed = True
+
+# Same queries in the consolidated store, for one user and for all the users
+store = module.ConnectionStore(os.path.join(os.path.dirname(dbPath), 'connections.db'))
+if not checkPlans(store.conn, module.ConsolidatedReportBuilder, (1, )):
+    failed = True
+if not checkPlans(store.conn, module.FleetReportBuilder, ()):
+    failed = True
+
+sys.exit(1 if failed else 0)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+# Local stand-in for the batch endpoint of ip-api.com, to test the providers
+# resolution of the access reports without external queries.
+# The provider returned is built from the network prefix of each address,
+# and the addresses of 9.9.9.0/24 are reported as not found.
+
+# Andre Rodier <andre@rodier.me>
+# Licence: GPL v2
+
+import json
+import argparse
+import ipaddress
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+class BatchHandler(BaseHTTPRequestHandler):
+    """Answer the batch queries like ip-api.com"""
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        queries = json.loads(self.rfile.read(length))
+
+        results = []
+        for query in queries:
+            ip = query['query'] if isinstance(query, dict) else query
+            network = ipaddress.ip_network(ip + ('/24' if '.' in ip else '/48'), strict=False)
+            if network == ipaddress.ip_network('9.9.9.0/24'):
+                results.append({'status': 'fail', 'message': 'reserved range', 'query': ip})
+            else:
+                results.append({'status': 'success', 'isp': 'Standin ISP {}'.format(network), 'query': ip})
+
+        body = json.dumps(results).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Rl', '14')
+        self.send_header('X-Ttl', '60')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+parser = argparse.ArgumentParser(description='ip-api.com batch endpoint stand-in')
+parser.add_argument('--port', type=int, default=8765, help="The port to listen to")
+args = parser.parse_args()
+
+HTTPServer(('127.0.0.1', args.port), BatchHandler).serve_forever()
@@ -0,0 +1,542 @@
+#!/usr/bin/env python3
+
+# Benchmark of the address book milter.
+# A database shaped like the SOGo, Roundcube or sqlite backend is filled with
+# synthetic users and contacts, the milter is started on a private socket, and
+# messages are sent to it with a minimal MTA side of the milter protocol.
+# The end of message latency percentiles and the throughput are reported,
+# and can be compared with a previous run.
+
+# Andre Rodier <andre@rodier.me>
+# Licence: GPL v2
+
+# Pylint options
+# too long lines: pylint: disable=C0301
+# catching too general exception: pylint: disable=W0703
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import socket
+import struct
+import sqlite3
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Milter protocol version and options offered by the MTA, like Postfix
+MILTER_VERSION = 6
+MILTER_ACTIONS = 0x1ff
+MILTER_PROTOCOL = 0x1fffff
+
+# Protocol flags: steps not sent, or sent without waiting for a reply
+P_NOCONNECT = 0x01
+P_NOHELO = 0x02
+P_NOMAIL = 0x04
+P_NORCPT = 0x08
+P_NOBODY = 0x10
+P_NOHDRS = 0x20
+P_NOEOH = 0x40
+P_NR_HDR = 0x80
+P_NODATA = 0x200
+P_NR_CONN = 0x1000
+P_NR_HELO = 0x2000
+P_NR_MAIL = 0x4000
+P_NR_RCPT = 0x8000
+P_NR_DATA = 0x10000
+P_NR_EOH = 0x40000
+P_NR_BODY = 0x80000
+
+# Final replies, ending a step
+FINAL_REPLIES = (b'a', b'c', b'd', b'r', b't', b'y')
+
+# Maximum size of a body chunk
+BODY_CHUNK_SIZE = 65535
+
+# Seconds between two writes of the milter metrics
+METRICS_INTERVAL = 1
+
+# Seconds to connect to the database, and to wait for the sqlite database when it is locked
+CONNECT_TIMEOUT = 2
+
+# Seconds allowed to the milter after the lookup deadline, to answer the end of message
+DEADLINE_MARGIN = 0.5
+
+# Extensions of the recipient addresses, all searched as the same user
+RECIPIENT_VARIANTS = ('{}', '{}+bench', '{}+other', '{}')
+
+
+class MilterClient(object):
+    """MTA side of the milter protocol, sending one message per session"""
+
+    def __init__(self, socketPath, timeout):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(socketPath)
+        self.protocol = 0
+        self.reply = None
+
+    def close(self):
+        """Quit the session and close the socket"""
+        try:
+            self.send(b'Q')
+        finally:
+            self.sock.close()
+
+    def send(self, command, data=b''):
+        """Send a command packet: length, command code and data"""
+        self.sock.sendall(struct.pack('!I', len(data) + 1) + command + data)
+
+    def receive(self):
+        """Read a reply packet, return the reply code and data"""
+        length = struct.unpack('!I', self.readExactly(4))[0]
+        payload = self.readExactly(length)
+        return payload[:1], payload[1:]
+
+    def readExactly(self, size):
+        """Read a fixed number of bytes from the socket"""
+        data = b''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise IOError("Connection closed by the milter")
+            data += chunk
+        return data
+
+    def step(self, command, data, skipFlag, noReplyFlag):
+        """Send a step, unless the milter asked to skip it, and wait for the reply if needed"""
+        if self.protocol & skipFlag:
+            return None
+
+        self.send(command, data)
+        if self.protocol & noReplyFlag:
+            return None
+
+        code, data = self.receive()
+        while code not in FINAL_REPLIES:
+            code, data = self.receive()
+        return code
+
+    def negotiate(self):
+        """Negotiate the version, the actions and the steps with the milter"""
+        self.send(b'O', struct.pack('!III', MILTER_VERSION, MILTER_ACTIONS, MILTER_PROTOCOL))
+        code, data = self.receive()
+        if code != b'O':
+            raise IOError("Unexpected negotiation reply {}".format(code))
+        self.protocol = struct.unpack('!III', data[:12])[2]
+
+    def sendMessage(self, sender, recipients, headers, body):
+        """Send a message, return the end of message latency and the headers added,
+        or None when the message is deferred or rejected by the milter.
+        The end of message reply code is kept in the reply attribute."""
+        self.negotiate()
+        self.step(b'C', b'bench.localdomain\0' + b'4' + struct.pack('!H', 25) + b'127.0.0.1\0', P_NOCONNECT, P_NR_CONN)
+        self.step(b'H', b'bench.localdomain\0', P_NOHELO, P_NR_HELO)
+        if self.step(b'M', '<{}>\0'.format(sender).encode(), P_NOMAIL, P_NR_MAIL) in (b'r', b't'):
+            return None, []
+        for recipient in recipients:
+            self.step(b'R', '<{}>\0'.format(recipient).encode(), P_NORCPT, P_NR_RCPT)
+        self.step(b'T', b'', P_NODATA, P_NR_DATA)
+        for name, value in headers:
+            self.step(b'L', '{}\0{}\0'.format(name, value).encode(), P_NOHDRS, P_NR_HDR)
+        self.step(b'N', b'', P_NOEOH, P_NR_EOH)
+        for position in range(0, len(body), BODY_CHUNK_SIZE):
+            self.step(b'B', body[position:position + BODY_CHUNK_SIZE], P_NOBODY, P_NR_BODY)
+
+        # The end of message is always answered, with the modifications first
+        startTime = time.time()
+        self.send(b'E')
+        added = []
+        code, data = self.receive()
+        while code not in FINAL_REPLIES:
+            if code == b'h':
+                added.append(tuple(part.decode() for part in data.split(b'\0')[:2]))
+            code, data = self.receive()
+
+        self.reply = code
+        return time.time() - startTime, added
+
+
+def emailHash(address):
+    """Signature of a normalised email address, as stored by the sqlite backend"""
+    return hashlib.sha256(address.strip().lower().encode('utf-8')).hexdigest()
+
+
+def contactAddress(user, contact):
+    """Synthetic address of a contact"""
+    return 'contact{:05d}.{}@example.org'.format(contact, user)
+
+
+def userName(user):
+    """Synthetic user name"""
+    return 'bench{:05d}'.format(user)
+
+
+def seedSQLite(path, nbUsers, nbContacts):
+    """Create the sqlite hashed addresses store"""
+    db = sqlite3.connect(path)
+    db.execute("create table addresses (uid varchar, email_hash char(64), source varchar, abook varchar,"
+               " contact varchar, primary key (uid, email_hash, source, abook, contact)) without rowid")
+    db.executemany("insert into addresses values (?, ?, 'Bench', 'Personal', ?)",
+                   ((userName(user), emailHash(contactAddress(user, contact)), str(contact))
+                    for user in range(nbUsers) for contact in range(nbContacts)))
+    db.commit()
+    db.close()
+
+
+def seedSOGo(dbConnection, nbUsers, nbContacts):
+    """Create the SOGo folders and contacts tables"""
+    cursor = dbConnection.cursor()
+    cursor.execute("create table sogo_folder_info (c_folder_id serial, c_path varchar, c_path2 varchar,"
+                   " c_foldername varchar, c_location varchar, c_folder_type varchar)")
+    for user in range(nbUsers):
+        uid = userName(user)
+        tableName = 'sogo{}bench'.format(uid)
+        cursor.execute("insert into sogo_folder_info (c_path, c_path2, c_foldername, c_location, c_folder_type)"
+                       " values (%s, %s, 'Personal', %s, 'Contact')",
+                       ('/Users/{}/Contacts/personal'.format(uid), uid,
+                        'postgresql://bench@127.0.0.1:5432/bench/{}'.format(tableName)))
+        cursor.execute("create table {} (c_name varchar, c_content text, c_creationdate integer,"
+                       " c_lastmodified integer, c_version integer, c_deleted integer)".format(tableName))
+        now = int(time.time())
+        cursor.executemany("insert into {} values (%s, %s, %s, %s, 0, 0)".format(tableName),
+                           (('{}.vcf'.format(contact),
+                             'BEGIN:VCARD\r\nVERSION:3.0\r\nFN:Contact {0}\r\nEMAIL;TYPE=work:{1}\r\nEND:VCARD\r\n'.format(
+                                 contact, contactAddress(user, contact)), now, now)
+                            for contact in range(nbContacts)))
+    dbConnection.commit()
+    cursor.close()
+
+
+def seedRoundcube(dbConnection, nbUsers, nbContacts):
+    """Create the Roundcube users, contacts and groups tables"""
+    cursor = dbConnection.cursor()
+    cursor.execute("create table users (user_id serial primary key, username varchar)")
+    cursor.execute("create table contacts (contact_id serial primary key, user_id integer, del smallint default 0,"
+                   " name varchar, email text, words text)")
+    cursor.execute("create table contactgroups (contactgroup_id serial primary key, user_id integer, name varchar)")
+    cursor.execute("create table contactgroupmembers (contactgroup_id integer, contact_id integer)")
+    for user in range(nbUsers):
+        cursor.execute("insert into users (username) values (%s) returning user_id", (userName(user), ))
+        userId = cursor.fetchone()[0]
+        cursor.execute("insert into contactgroups (user_id, name) values (%s, 'Personal') returning contactgroup_id",
+                       (userId, ))
+        groupId = cursor.fetchone()[0]
+        for contact in range(nbContacts):
+            address = contactAddress(user, contact)
+            cursor.execute("insert into contacts (user_id, name, email, words) values (%s, %s, %s, %s)"
+                           " returning contact_id", (userId, 'Contact {}'.format(contact), address,
+                                                     ' contact {} {}'.format(contact, address)))
+            cursor.execute("insert into contactgroupmembers values (%s, %s)", (groupId, cursor.fetchone()[0]))
+    dbConnection.commit()
+    cursor.close()
+
+
+def writeConfig(args, workDir):
+    """Write the milter configuration, for the backend to benchmark"""
+    configPath = os.path.join(workDir, 'milters.conf')
+    with open(configPath, 'w') as configFile:
+        configFile.write("[main]\ndebug=false\nname=milter-abook-bench\n")
+        configFile.write("socket={}\npid_file={}\n".format(os.path.join(workDir, 'milter.socket'),
+                                                          os.path.join(workDir, 'milter.pid')))
+        configFile.write("recipient_delimiter=+\nbackends={}\nworkers={}\n".format(args.backend, args.workers))
+        configFile.write("worker_model={}\nmax_pending={}\n\n".format(args.worker_model, args.max_pending))
+        if args.backend == 'sqlite':
+            configFile.write("[sqlite]\npath={}\n\n".format(os.path.join(workDir, 'addresses.db')))
+        else:
+            configFile.write("[{}]\nuser={}\npassword={}\ndbName={}\nmax_connections={}\n\n".format(
+                args.backend, args.db_user, args.db_password, args.db_name, args.workers))
+        configFile.write("[cache]\nsize=10000\nttl=3600\ncheck_interval=60\n\n")
+        configFile.write("[timeouts]\nconnect={}\nstatement=1\nlookup={}\n\n".format(CONNECT_TIMEOUT,
+                                                                                   args.lookup_timeout))
+        configFile.write("[breaker]\nfailures={}\ncooldown={}\n\n".format(args.breaker_failures,
+                                                                         args.breaker_cooldown))
+        configFile.write("[bloom]\nfalse_positive_rate=0.001\nrebuild_interval=3600\n\n")
+        configFile.write("[snapshot]\npath={}\ninterval=300\n\n".format(os.path.join(workDir, 'snapshot.bin')))
+        configFile.write("[metrics]\npath={}\ninterval={}\n".format(os.path.join(workDir, 'metrics.prom'),
+                                                                METRICS_INTERVAL))
+    return configPath
+
+
+def percentile(values, rank):
+    """Return the percentile of sorted values, e.g. rank=0.99"""
+    if not values:
+        return 0
+    return values[max(int(math.ceil(rank * len(values))) - 1, 0)]
+
+
+def runMessages(args, socketPath, nbMessages):
+    """Send the messages concurrently, return the latencies, the tagged and deferred messages counts,
+    and the duration"""
+    random.seed(args.seed)
+    body = (b'x' * 76 + b'\r\n') * (args.body_size // 78 + 1)
+    body = body[:args.body_size]
+    messages = []
+    for _ in range(nbMessages):
+        users = random.sample(range(args.users), min(args.recipients, args.users))
+        if random.random() < args.known_ratio:
+            sender = contactAddress(users[0], random.randrange(args.contacts))
+        else:
+            sender = 'unknown{:08d}@example.net'.format(random.randrange(10 ** 8))
+        messages.append((sender, ['{}@localdomain'.format(userName(user)) for user in users]))
+
+    latencies = []
+    tagged = [0]
+    deferred = [0]
+    lock = threading.Lock()
+
+    def sendOne(message):
+        client = MilterClient(socketPath, args.timeout)
+        try:
+            latency, added = client.sendMessage(message[0], message[1],
+                                                [('From', message[0]), ('Subject', 'Benchmark')], body)
+        finally:
+            client.close()
+        with lock:
+            if latency is None:
+                deferred[0] += 1
+                return
+            latencies.append(latency)
+            if any(name == 'X-AddressBook' for name, _ in added):
+                tagged[0] += 1
+
+    startTime = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for result in executor.map(sendOne, messages):
+            pass
+    duration = time.time() - startTime
+
+    return sorted(latencies), tagged[0], deferred[0], duration
+
+
+def readCounter(metricsPath, name):
+    """Return the sum of a counter, for all its labels, in the milter metrics file"""
+    total = 0
+    with open(metricsPath) as metricsFile:
+        for line in metricsFile:
+            if line.startswith(name + '{') or line.startswith(name + ' '):
+                total += float(line.rsplit(' ', 1)[1])
+    return total
+
+
+def checkTableSearches(args, socketPath, metricsPath, nbMessages):
+    """Send messages from known senders to two users, each with duplicate and extended addresses,
+    and return the address book tables searched, and the maximum expected: one search per table
+    and sender, i.e. per user, as each synthetic user has one address book"""
+    time.sleep(METRICS_INTERVAL * 2)
+    searchesBefore = readCounter(metricsPath, 'milter_table_searches_total')
+
+    for message in range(nbMessages):
+        users = [message % args.users, (message + 1) % args.users]
+        sender = contactAddress(users[0], (message * 7) % args.contacts)
+        recipients = [variant.format(userName(user)) + '@localdomain'
+                      for user in users for variant in RECIPIENT_VARIANTS]
+        client = MilterClient(socketPath, args.timeout)
+        try:
+            client.sendMessage(sender, recipients, [('From', sender), ('Subject', 'Benchmark')], b'Check\r\n')
+        finally:
+            client.close()
+
+    time.sleep(METRICS_INTERVAL * 2)
+    return readCounter(metricsPath, 'milter_table_searches_total') - searchesBefore, nbMessages * 2
+
+
+def sendCheckMessage(args, socketPath, user):
+    """Send a message from a contact of the user, return the end of message latency, reply and headers added"""
+    sender = contactAddress(user, 0)
+    client = MilterClient(socketPath, args.timeout)
+    try:
+        latency, added = client.sendMessage(sender, ['{}@localdomain'.format(userName(user))],
+                                            [('From', sender), ('Subject', 'Benchmark')], b'Check\r\n')
+    finally:
+        client.close()
+    return latency, client.reply, [name for name, _ in added]
+
+
+def checkBreaker(args, workDir, socketPath, metricsPath):
+    """Lock the sqlite database, so the lookups wait for it, are too slow and fail, and check the messages
+    are accepted without the header by the lookup deadline, the lookups are skipped after the configured
+    failures, and one lookup probes the database again after the cool-down period.
+    Return the failed checks."""
+    failedChecks = []
+    maxLatency = args.lookup_timeout + DEADLINE_MARGIN
+
+    lockConnection = sqlite3.connect(os.path.join(workDir, 'addresses.db'), isolation_level=None)
+    lockConnection.execute("pragma journal_mode=delete")
+    lockConnection.execute("begin exclusive")
+    try:
+        for _ in range(args.breaker_failures):
+            latency, reply, added = sendCheckMessage(args, socketPath, 0)
+            if reply != b'a' or latency is None or latency > maxLatency or 'X-AddressBook' in added:
+                failedChecks.append("Message not accepted without the header within {:.1f}s with the database"
+                                    " locked: reply {}, latency {}, headers {}".format(maxLatency, reply, latency,
+                                                                                        added))
+
+        # Wait for the lookups still waiting for the database
+        time.sleep(CONNECT_TIMEOUT + METRICS_INTERVAL * 2)
+        if readCounter(metricsPath, 'milter_breaker_open') != 1:
+            failedChecks.append("Breaker not opened after {} failed lookups".format(args.breaker_failures))
+
+        skippedBefore = readCounter(metricsPath, 'milter_breaker_total')
+        latency, reply, added = sendCheckMessage(args, socketPath, 0)
+        time.sleep(METRICS_INTERVAL * 2)
+        if reply != b'a' or readCounter(metricsPath, 'milter_breaker_total') <= skippedBefore:
+            failedChecks.append("Lookup not skipped with the breaker opened: reply {}".format(reply))
+
+    finally:
+        lockConnection.rollback()
+        lockConnection.close()
+
+    # The database is available again, one lookup probes it after the cool-down period
+    time.sleep(args.breaker_cooldown)
+    latency, reply, added = sendCheckMessage(args, socketPath, 0)
+    time.sleep(METRICS_INTERVAL * 2)
+    if reply != b'a' or 'X-AddressBook' not in added:
+        failedChecks.append("Message not tagged by the probe after {}s: reply {}, headers {}".format(
+            args.breaker_cooldown, reply, added))
+    if readCounter(metricsPath, 'milter_breaker_open') != 0:
+        failedChecks.append("Breaker still opened after a successful probe")
+
+    return failedChecks
+
+
+def main(args):
+    """Seed the database, start the milter, send the messages and report"""
+
+    workDir = tempfile.mkdtemp(prefix='milter-abook-bench-')
+    configPath = writeConfig(args, workDir)
+    socketPath = os.path.join(workDir, 'milter.socket')
+
+    print("Seeding the {} database with {} users x {} contacts".format(args.backend, args.users, args.contacts))
+    if args.backend == 'sqlite':
+        seedSQLite(os.path.join(workDir, 'addresses.db'), args.users, args.contacts)
+    else:
+        import psycopg2
+        dbConnection = psycopg2.connect(host='127.0.0.1', user=args.db_user,
+                                        password=args.db_password, dbname=args.db_name)
+        if args.backend == 'sogo':
+            seedSOGo(dbConnection, args.users, args.contacts)
+        else:
+            seedRoundcube(dbConnection, args.users, args.contacts)
+        dbConnection.close()
+
+    milter = subprocess.Popen([sys.executable, args.milter, '--config', configPath])
+    try:
+        # Wait for the milter socket
+        deadline = time.time() + args.timeout
+        while not os.path.exists(socketPath):
+            if time.time() > deadline or milter.poll() is not None:
+                raise IOError("The milter did not start")
+            time.sleep(0.1)
+
+        # Let the caches and the known addresses filter warm up
+        runMessages(args, socketPath, args.warmup)
+        latencies, tagged, deferred, duration = runMessages(args, socketPath, args.messages)
+        tableSearches, tableSearchesMax = checkTableSearches(args, socketPath,
+                                                             os.path.join(workDir, 'metrics.prom'), 20)
+
+        # Make the backend fail, the database being locked
+        failedChecks = []
+        if args.check_breaker:
+            failedChecks = checkBreaker(args, workDir, socketPath, os.path.join(workDir, 'metrics.prom'))
+
+    finally:
+        milter.terminate()
+        milter.wait()
+
+    results = {
+        'backend': args.backend,
+        'users': args.users,
+        'contacts': args.contacts,
+        'recipients': args.recipients,
+        'body_size': args.body_size,
+        'concurrency': args.concurrency,
+        'messages': len(latencies),
+        'tagged': tagged,
+        'deferred': deferred,
+        'throughput': len(latencies) / duration,
+        'eom_p50_ms': percentile(latencies, 0.50) * 1000,
+        'eom_p99_ms': percentile(latencies, 0.99) * 1000,
+        'eom_max_ms': percentile(latencies, 1) * 1000,
+        'table_searches': tableSearches,
+        'table_searches_max': tableSearchesMax,
+        'failed_checks': failedChecks,
+    }
+
+    print("Backend {backend}, messages: {messages} ({tagged} tagged, {deferred} deferred), {recipients} recipient(s),"
+          " {body_size} bytes, concurrency {concurrency}".format(**results))
+    print("Throughput: {throughput:.1f} messages/s".format(**results))
+    print("End of message latency: p50 {eom_p50_ms:.2f} ms, p99 {eom_p99_ms:.2f} ms,"
+          " max {eom_max_ms:.2f} ms".format(**results))
+    print("Address book tables searched for duplicate and extended recipients: {table_searches:.0f},"
+          " at most {table_searches_max} expected".format(**results))
+
+    if args.check_breaker:
+        print("Locked database checks: {}".format('; '.join(failedChecks) or 'passed'))
+
+    # Compare with a previous run
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            baseline = json.load(baselineFile)
+        for key in ('throughput', 'eom_p50_ms', 'eom_p99_ms'):
+            if baseline.get(key):
+                print("{}: {:.2f} (baseline {:.2f}, {:+.1%})".format(
+                    key, results[key], baseline[key], results[key] / baseline[key] - 1))
+
+    if args.output:
+        with open(args.output, 'w') as outputFile:
+            json.dump(results, outputFile, indent=2)
+
+    if failedChecks:
+        sys.exit(1)
+
+
+################################################################################
+# parse arguments, build the manager, and call it
+# Main call with the arguments
+
+parser = argparse.ArgumentParser(description='Address book milter benchmark')
+
+parser.add_argument('--milter', type=str, default='/usr/local/bin/milter-sogo-abook.py',
+                    help="The milter program to benchmark")
+parser.add_argument('--backend', type=str, choices=['sqlite', 'sogo', 'roundcube'], default='sqlite',
+                    help="The backend to benchmark. sogo and roundcube need an empty PostgreSQL database")
+parser.add_argument('--db-user', type=str, help="PostgreSQL user, for the sogo and roundcube backends")
+parser.add_argument('--db-password', type=str, help="PostgreSQL password, for the sogo and roundcube backends")
+parser.add_argument('--db-name', type=str, help="PostgreSQL empty database, for the sogo and roundcube backends")
+parser.add_argument('--users', type=int, default=100, help="Number of users")
+parser.add_argument('--contacts', type=int, default=200, help="Number of contacts per user")
+parser.add_argument('--messages', type=int, default=1000, help="Number of messages measured")
+parser.add_argument('--warmup', type=int, default=100, help="Number of messages sent before measuring")
+parser.add_argument('--recipients', type=int, default=1, help="Number of recipients per message")
+parser.add_argument('--body-size', type=int, default=10240, help="Size of the message body, in bytes")
+parser.add_argument('--concurrency', type=int, default=8, help="Number of SMTP sessions at the same time")
+parser.add_argument('--workers', type=int, default=10, help="Milter workers and database connections")
+parser.add_argument('--worker-model', type=str, choices=['threads', 'processes'], default='threads',
+                    help="Run the milter lookups in threads or in processes")
+parser.add_argument('--max-pending', type=int, default=100, help="Milter lookups queued before deferring messages")
+parser.add_argument('--known-ratio', type=float, default=0.2,
+                    help="Ratio of messages sent by a contact of the first recipient")
+parser.add_argument('--lookup-timeout', type=float, default=2, help="Milter lookup deadline, in seconds")
+parser.add_argument('--breaker-failures', type=int, default=5,
+                    help="Milter failed or slow lookups before skipping the lookups")
+parser.add_argument('--breaker-cooldown', type=int, default=30,
+                    help="Milter seconds to skip the lookups, before probing the backend")
+parser.add_argument('--check-breaker', action='store_true',
+                    help="Check the deadline and the breaker with the sqlite database locked, after the benchmark")
+parser.add_argument('--timeout', type=float, default=30, help="Timeout, in seconds")
+parser.add_argument('--seed', type=int, default=0, help="Random seed, to send the same messages")
+parser.add_argument('--output', type=str, help="Save the results in this JSON file")
+parser.add_argument('--baseline', type=str, help="Compare with the results saved in this JSON file")
+
+# Call the entry point
+arguments = parser.parse_args()
+if arguments.check_breaker and arguments.backend != 'sqlite':
+    parser.error("the breaker is checked with the sqlite backend only")
+main(arguments)